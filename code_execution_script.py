@@ -1,40 +1,21 @@
 import asyncio
 import logging
-import json
-import time
 import argparse
-from src.async_client import OpenAI
+from src.async_client import OpenAI, aclose_clients
 from src.prompt import TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT
 from src.tools import file_write, file_read, explore_directory, search_in_files, complete, make_dirs
 from src.function_call import LLMToolManager
 from src.code_interpreter import CodeInterpreter
+from src.utils import fast_dumps, ainput, StreamingArrayParser
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-async def generate_and_execute_code(goal: str):
-    logging.debug("Starting generate_and_execute_code with goal: %s", goal)
-    # Initialize the LLM client with system prompt
-    deep_seek_engineer = OpenAI("o3-mini", TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT)
-    
-    logging.debug("Initializing tool manager and registering available functions")
-    tool_manager = LLMToolManager()
-    tool_manager.register(file_write)
-    tool_manager.register(file_read)
-    tool_manager.register(explore_directory)
-    tool_manager.register(search_in_files)
-    tool_manager.register(complete)
-    tool_manager.register(make_dirs)
-    
-    logging.debug("Initializing CodeInterpreter with registered tools")
-    code_interpreter = CodeInterpreter(functions=tool_manager.functions)
-    pre_execute_code = "state = {}"
-    current_state = code_interpreter.parse_and_execute(pre_execute_code)
-    
-    # Define a structured prompt for code generation
-    prompt = f"""You are tasked with generating executable Python code snippets to fulfill a specific goal using the CodeInterpreter system. The CodeInterpreter operates under the following guidelines:
+
+# Structured prompt for code generation, filled in with str.format_map
+PROMPT_TEMPLATE = """You are tasked with generating executable Python code snippets to fulfill a specific goal using the CodeInterpreter system. The CodeInterpreter operates under the following guidelines:
 1. Execution Environment:
-   - Utilizes Python's InteractiveInterpreter.
+   - Executes each snippet with exec() in a namespace shared by all snippets.
    - Supports predefined tool functions registered for execution.
    - Maintains a "state" variable showing the current state of the execution.
    - If you complete the goal, set the "state" variable to "completed".
@@ -46,9 +27,10 @@ async def generate_and_execute_code(goal: str):
 
 3. Expected Execution Results:
    - Returns a dictionary containing:
-     - "status": {"success", "error"}
+     - "status": {{"success", "error"}}
      - "code": string of the executed code
      - "state": current state object
+     - "output": anything the code printed
      - "message": error message if any
 
 4. Response Format:
@@ -66,53 +48,129 @@ async def generate_and_execute_code(goal: str):
    - Each snippet execution requires prior human confirmation.
    - Aim to effectively achieve the specified goal with these snippets.
 
-Please write code snippets to achieve the following goal: {goal}
-
 ## Available tools
-{json.dumps(tool_manager.tools, indent=2, ensure_ascii=False)}
+{tools_json}
 
 ## Current state
 
 already executed code:
-{json.dumps(code_interpreter.history, indent=2, ensure_ascii=False)}
+{history_json}
+
+Please write code snippets to achieve the following goal: {goal}
 """
 
-    logging.debug("Requesting the LLM to generate code")
-    response = await deep_seek_engineer.chat(prompt.strip())
-    logging.debug("Raw LLM Response: %s", response)
+
+class SnippetStream:
+    """
+    Streams one LLM reply in the background and yields its "code_snippets" items
+    as soon as each one is complete, so the user can review the first snippet
+    while the rest of the reply is still being generated.
+    """
+    def __init__(self, agent: OpenAI, prompt: str):
+        self.items = []
+        self.found = False
+        self._updated = asyncio.Event()
+        self._task = asyncio.create_task(self._produce(agent, prompt))
+
+    async def _produce(self, agent: OpenAI, prompt: str):
+        parser = StreamingArrayParser("code_snippets")
+        try:
+            async for delta in agent.chat_stream(prompt):
+                items = parser.feed(delta)
+                if items:
+                    self.items.extend(items)
+                    self._updated.set()
+        finally:
+            self.found = parser.found
+            self._updated.set()
+
+    async def wait(self):
+        """Wait until the whole reply has been received and added to the agent's history."""
+        await self._task
+
+    async def __aiter__(self):
+        i = 0
+        while True:
+            if i < len(self.items):
+                yield self.items[i]
+                i += 1
+            elif self._task.done():
+                self._task.result()
+                return
+            else:
+                self._updated.clear()
+                await self._updated.wait()
+
+async def generate_and_execute_code(goal: str):
+    logging.debug("Starting generate_and_execute_code with goal: %s", goal)
+    # Initialize the LLM client with system prompt
+    deep_seek_engineer = OpenAI("o3-mini", TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT)
     
-    # Extract code snippets from response
-    try:
-        response_data = json.loads(response)
-        code_snippets = response_data.get("code_snippets", [])
-    except json.JSONDecodeError as e:
-        logging.error("Failed to parse LLM response: %s", e)
-        return
+    logging.debug("Initializing tool manager and registering available functions")
+    tool_manager = LLMToolManager()
+    tool_manager.register(file_write)
+    tool_manager.register(file_read)
+    tool_manager.register(explore_directory)
+    tool_manager.register(search_in_files)
+    tool_manager.register(complete)
+    tool_manager.register(make_dirs)
+    
+    logging.debug("Initializing CodeInterpreter with registered tools")
+    code_interpreter = CodeInterpreter(functions=tool_manager.functions)
+    pre_execute_code = "state = {}"
+    current_state = code_interpreter.parse_and_execute(pre_execute_code)
+
+    # Serialize the tool schemas and execution history once, outside the prompt template
+    tools_json = tool_manager.tools_json
+    history_json = fast_dumps(code_interpreter.history, indent=True)
+
+    prompt = PROMPT_TEMPLATE.format_map({
+        "tools_json": tools_json,
+        "history_json": history_json,
+        "goal": goal,
+    })
+
+    logging.debug("Requesting the LLM to generate code")
+    snippets = SnippetStream(deep_seek_engineer, prompt.strip())
 
     logging.debug("Iterating and executing code snippets with user confirmation")
     while True:
-      for code_snippet in code_snippets:
+      reply = None
+      position = 0
+      async for code_snippet in snippets:
           logging.debug("Generated code snippet: %s", code_snippet)
-          confirm = input("Do you want to execute this code snippet? (y/n): ")
+          confirm = await ainput("Do you want to execute this code snippet? (y/n, Y: all remaining): ")
+          run_all = confirm == 'Y'
+          if run_all:
+              # Approve every remaining snippet of this reply and execute them as one batch
+              await snippets.wait()
+              code_snippet = "\n".join(snippets.items[position:])
           if confirm.lower() == 'y':
               logging.debug("Executing code snippet")
-              code_result = code_interpreter.parse_and_execute(code_snippet)
+              # Run in a worker thread so the reply stream keeps being consumed meanwhile
+              code_result = await asyncio.to_thread(code_interpreter.parse_and_execute, code_snippet)
               logging.debug("Execution result: %s", code_result)
-              next_prompt = "Execution result: " + json.dumps(code_result, indent=2, ensure_ascii=False)
+              next_prompt = "Execution result: " + fast_dumps(code_result, indent=True)
               if code_result == "completed":
                 logging.debug("Goal completed")
                 return
           else:
-            next_prompt = input("Enter next instruction: ")
+            next_prompt = await ainput("Enter next instruction: ")
+          # The agent's history must be complete before the next request is added to it
+          await snippets.wait()
+          if reply is not None:
+              await reply.wait()
           logging.debug("Requesting the LLM with next prompt")
-          response = await deep_seek_engineer.chat(next_prompt)
-      try:
-          response_data = json.loads(response)
-          code_snippets = response_data.get("code_snippets", [])
-      except json.JSONDecodeError as e:
-          logging.error("Failed to parse LLM response: %s", e)
+          reply = SnippetStream(deep_seek_engineer, next_prompt)
+          if run_all:
+              break
+          position += 1
+      if not snippets.found:
+          logging.error("Failed to parse LLM response: %s", deep_seek_engineer.messages[-1].content)
           return
-      time.sleep(1)
+      if reply is not None:
+          snippets = reply
+      await asyncio.sleep(1)
         
 
 async def main():
@@ -120,7 +178,10 @@ async def main():
     parser.add_argument('--goal', type=str, required=True, help='The goal to be achieved through code execution.')
     args = parser.parse_args()
     
-    await generate_and_execute_code(args.goal)
+    try:
+        await generate_and_execute_code(args.goal)
+    finally:
+        await aclose_clients()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,30 +1,25 @@
 import asyncio
-import json
 from src.client import DeepSeek as DeepSeekSync
 from src.client import OpenAI as OpenAISync
 from src.prompt import TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT, TASK_RUNNNER
 from src.type import Agent
 from src.tools import explore_directory, search_in_files, file_read, file_write, complete, make_dirs, user_input, Planner, CodeReviewer, TaskReviewer
 from src.function_call import LLMToolManager
-from src.async_client import DeepSeekToolUse, OpenAIToolUse
-
-def clip_string(string: str, max_length: int):
-    if len(string) > max_length:
-        return string[:max_length - 3] + "\n output is too long ..."
-    return string
+from src.async_client import DeepSeekToolUse, OpenAIToolUse, aclose_clients
+from src.utils import fast_dumps, ainput
 
 async def code_generate(coder: DeepSeekToolUse, planner: Planner, code_reviewer: CodeReviewer, task_reviewer: TaskReviewer, goal: str, max_steps: int):
   tool_manager = LLMToolManager()
   tool_manager.register(file_write)
-  tool_manager.register(file_read)
-  tool_manager.register(explore_directory)
-  tool_manager.register(search_in_files)
+  tool_manager.register(file_read, concurrent_safe=True)
+  tool_manager.register(explore_directory, concurrent_safe=True)
+  tool_manager.register(search_in_files, concurrent_safe=True)
   tool_manager.register(complete)
   tool_manager.register(make_dirs)
   # tool_manager.register(user_input)
   # tool_manager.register(planner.planning)
-  tool_manager.register(code_reviewer.review_code)
-  tool_manager.register(task_reviewer.review_task)
+  tool_manager.register(code_reviewer.review_code, concurrent_safe=True)
+  tool_manager.register(task_reviewer.review_task, concurrent_safe=True)
   next_prompt = goal
   for i in range(max_steps):
     print(i)
@@ -42,37 +37,42 @@ async def code_generate(coder: DeepSeekToolUse, planner: Planner, code_reviewer:
       print(message)
       # next_prompt = "function cannot call.If finish task call complete, not finish task call next function."
       coder.pop_message()
-      next_prompt = input("指示を入力: ")
+      next_prompt = await ainput("指示を入力: ")
     else:
+      # 先にすべての呼び出しの確認を取り、承認されたものをまとめて実行する
+      confirmed = []
       for f in function_calls:
         print("実行する関数:")
         print(f.function.name)
         print("引数:")
         print(f.function.arguments)
-        yN = input("実行しますか?(y)次の指示を:")
+        yN = await ainput("実行しますか?(y)次の指示を:")
         if yN == "y":
-          try:
-            func_res = tool_manager.exec(f.function)
-            print("結果:")
-            print(func_res)
-            if func_res == "COMPLETE":
-              print("COMPLETE")
-              return 
-            print(f)
-            coder.append_message({
-                "role": "tool",
-                "tool_call_id": f.id,
-                "content": json.dumps(func_res)
-            })
-            next_prompt = f"please think next action."
-            print(len(next_prompt))
-          except Exception as e:
-            print(e)
-            coder.pop_message()
-            next_prompt = f"Error following: {e}"
+          confirmed.append(f)
         else:
           coder.pop_message()
           next_prompt = yN
+      # 読み取り系のツールは並列に、それ以外は順番に実行される
+      results = await tool_manager.exec_many([f.function for f in confirmed])
+      for f, func_res in zip(confirmed, results):
+        if isinstance(func_res, Exception):
+          print(func_res)
+          coder.pop_message()
+          next_prompt = f"Error following: {func_res}"
+          continue
+        print("結果:")
+        print(func_res)
+        if func_res == "COMPLETE":
+          print("COMPLETE")
+          return
+        print(f)
+        coder.append_message({
+            "role": "tool",
+            "tool_call_id": f.id,
+            "content": fast_dumps(func_res)
+        })
+        next_prompt = f"please think next action."
+        print(len(next_prompt))
 
 
 async def main():
@@ -83,6 +83,8 @@ async def main():
   qa_ds = DeepSeekToolUse("o1", TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT)
   o1_engineer = OpenAISync("o1", TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT)
   o3_mini_reviwer = OpenAISync("o3-mini", TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT, "high")
+  # コードレビューと並列に動かせるよう、タスクレビューは別インスタンスにする
+  o3_mini_task_reviwer = OpenAISync("o3-mini", TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT, "high")
   o3_mini_engineer = OpenAIToolUse("o3-mini", TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT, "medium")
   r1_engineer = DeepSeekSync("deepseek-reasoner", TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT)
   r1_deep_seek_engineer = DeepSeekToolUse("deepseek-reasoner", TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT)
@@ -96,9 +98,12 @@ async def main():
   code_reviewer = CodeReviewer(r1_engineer)
   code_reviewer = CodeReviewer(o3_mini_reviwer)
   task_reviewer = TaskReviewer(r1_deep_seek_engineer)
-  task_reviewer = TaskReviewer(o3_mini_reviwer)
+  task_reviewer = TaskReviewer(o3_mini_task_reviwer)
   goal =  "/home/onzw/python/chart/task/todo/を確認してやるべきタスクをすすめてください。"
-  res = await code_generate(engineer, planner, code_reviewer, task_reviewer, goal, 100)
+  try:
+    res = await code_generate(engineer, planner, code_reviewer, task_reviewer, goal, 100)
+  finally:
+    await aclose_clients()
 
 if __name__ == "__main__":
     asyncio.run(main())
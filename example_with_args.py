@@ -1,5 +1,4 @@
 import asyncio
-import json
 import argparse
 from src.client import DeepSeek as DeepSeekSync
 from src.client import OpenAI as OpenAISync
@@ -7,25 +6,21 @@ from src.prompt import TOP_LEVEL_SOFTWARE_ENGINEER_SYSTEM_PROMPT
 from src.type import Agent
 from src.tools import explore_directory, search_in_files, file_read, file_write, complete, make_dirs, user_input, Planner, CodeReviewer, TaskReviewer
 from src.function_call import LLMToolManager
-from src.async_client import DeepSeekToolUse, OpenAIToolUse
-
-def clip_string(string: str, max_length: int):
-    if len(string) > max_length:
-        return string[:max_length - 3] + "\n output is too long ..."
-    return string
+from src.async_client import DeepSeekToolUse, OpenAIToolUse, aclose_clients
+from src.utils import fast_dumps, ainput
 
 async def code_generate(coder: DeepSeekToolUse, planner: Planner, code_reviewer: CodeReviewer, task_reviewer: TaskReviewer, goal: str, max_steps: int):
   tool_manager = LLMToolManager()
   tool_manager.register(file_write)
-  tool_manager.register(file_read)
-  tool_manager.register(explore_directory)
-  tool_manager.register(search_in_files)
+  tool_manager.register(file_read, concurrent_safe=True)
+  tool_manager.register(explore_directory, concurrent_safe=True)
+  tool_manager.register(search_in_files, concurrent_safe=True)
   tool_manager.register(complete)
   tool_manager.register(make_dirs)
   # tool_manager.register(user_input)
   # tool_manager.register(planner.planning)
-  tool_manager.register(code_reviewer.review_code)
-  tool_manager.register(task_reviewer.review_task)
+  tool_manager.register(code_reviewer.review_code, concurrent_safe=True)
+  tool_manager.register(task_reviewer.review_task, concurrent_safe=True)
   next_prompt = goal
   for i in range(max_steps):
     print(i)
@@ -42,37 +37,42 @@ async def code_generate(coder: DeepSeekToolUse, planner: Planner, code_reviewer:
     if function_calls is None:
       print(message)
       coder.pop_message()
-      next_prompt = input("Enter next instruction: ")
+      next_prompt = await ainput("Enter next instruction: ")
     else:
+      # Confirm every call first, then run the approved ones together
+      confirmed = []
       for f in function_calls:
         print("Function to execute:")
         print(f.function.name)
         print("Arguments:")
         print(f.function.arguments)
-        yN = input("Execute? (y) Next command:")
+        yN = await ainput("Execute? (y) Next command:")
         if yN == "y":
-          try:
-            func_res = tool_manager.exec(f.function)
-            print("Result:")
-            print(func_res)
-            if func_res == "COMPLETE":
-              print("COMPLETE")
-              return 
-            print(f)
-            coder.append_message({
-                "role": "tool",
-                "tool_call_id": f.id,
-                "content": json.dumps(func_res)
-            })
-            next_prompt = "please think next action."
-            print(len(next_prompt))
-          except Exception as e:
-            print(e)
-            coder.pop_message()
-            next_prompt = f"Error following: {e}"
+          confirmed.append(f)
         else:
           coder.pop_message()
           next_prompt = yN
+      # Read-only tools run concurrently; the rest run in order
+      results = await tool_manager.exec_many([f.function for f in confirmed])
+      for f, func_res in zip(confirmed, results):
+        if isinstance(func_res, Exception):
+          print(func_res)
+          coder.pop_message()
+          next_prompt = f"Error following: {func_res}"
+          continue
+        print("Result:")
+        print(func_res)
+        if func_res == "COMPLETE":
+          print("COMPLETE")
+          return
+        print(f)
+        coder.append_message({
+            "role": "tool",
+            "tool_call_id": f.id,
+            "content": fast_dumps(func_res)
+        })
+        next_prompt = "please think next action."
+        print(len(next_prompt))
 
 
 async def main(goal):
@@ -90,7 +90,10 @@ async def main(goal):
   code_reviewer = CodeReviewer(r1_engineer)
   task_reviewer = TaskReviewer(r1_deep_seek_engineer)
   task_reviewer = TaskReviewer(o3_mini_engineer)
-  res = await code_generate(engineer, planner, code_reviewer, task_reviewer, goal, 100)
+  try:
+    res = await code_generate(engineer, planner, code_reviewer, task_reviewer, goal, 100)
+  finally:
+    await aclose_clients()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process arguments for example.py")
@@ -1,27 +1,153 @@
-import json
+import os
 from pydantic import BaseModel
 from openai import AsyncOpenAI
-from typing import List, Dict, Any, Tuple
+from openai.types.chat import ChatCompletion
+from typing import List, Dict, Any, Tuple, Optional, AsyncIterator
 from pydantic import BaseModel
 import uuid
+import asyncio
+import datetime
+import functools
+from collections import deque
+import httpx
 
 from .type import Agent, Message
 from .secret import DEEP_SEEK_API_KEY, OPENAI_API_KEY, GEMINI_API_KEY
+from .llm_cache import LLM_CACHE_ENABLED, default_cache, make_cache_key, SemanticCache
+from .utils import prune_tool_messages, fast_loads, extract_json_object, HTTP2_AVAILABLE
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig
 
+try:
+    import sentencepiece
+except ImportError:  # sentencepiece が無い環境では count_tokens は API で数える
+    sentencepiece = None
+
+# Gemini のトークナイザー (SentencePiece の .model ファイル)。指定するとトークン数をローカルで数える
+GEMINI_TOKENIZER_PATH = os.environ.get("GEMINI_TOKENIZER_PATH")
+
+
+@functools.lru_cache(maxsize=None)
+def _load_tokenizer(path: str):
+    return sentencepiece.SentencePieceProcessor(model_file=path)
+
+
+# GeminiToolUse のプロンプトの固定部分。呼び出しごとに変わる部分より前に置き、プロバイダ側のキャッシュを効かせる
+_GEMINI_TOOL_INSTRUCTIONS = """指示: 最後のユーザーメッセージに対して適切なツールを選択し、1つだけ使用してください。ツールを使用する場合は、以下の形式で応答してください.直接Pythonのjson.loadsでパースできるように余計な文字は入れないでPythonのdict形式で出力してください.変数を埋め込まないで直接値を入れて。いきなりすべてを行わずに細かく実行して。：
+```{
+    "name": "ツール名",
+    "arguments": {
+        "arg1": "値1",
+        "arg2": "値2"
+    }
+}```
+
+ツールを使用しない場合は、通常の応答を行ってください。複数のツールを使用する場合は、それぞれのツール使用を別々に記述してください。"""
+
+
+# (base_url, api_key) ごとに共有する AsyncOpenAI クライアント
+_clients: Dict[Tuple[Optional[str], str], AsyncOpenAI] = {}
+
+
+def _client_for(base_url: Optional[str], api_key: str) -> AsyncOpenAI:
+    """
+    (base_url, api_key) ごとに AsyncOpenAI クライアントを1つだけ作って共有する。
+    エージェント間でコネクションプールを使い回し、TLS ハンドシェイクを減らす。
+    h2 がインストールされていれば HTTP/2 で並行リクエストを多重化する。
+    """
+    key = (base_url, api_key)
+    client = _clients.get(key)
+    if client is None:
+        http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+            timeout=httpx.Timeout(600.0, connect=5.0),
+        )
+        client = _clients[key] = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+    return client
+
+
+async def aclose_clients() -> None:
+    """
+    共有している AsyncOpenAI クライアントをすべて閉じる。終了時に1回呼ぶ。
+    """
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.close()
+
+
+def _cached_prompt_tokens(usage: Any) -> int:
+    """
+    usage からプロンプトキャッシュにヒットしたトークン数を取り出す。
+    OpenAI は prompt_tokens_details.cached_tokens (Responses API は input_tokens_details.cached_tokens)、
+    DeepSeek は prompt_cache_hit_tokens で返す。
+    """
+    if usage is None:
+        return 0
+    details = getattr(usage, "prompt_tokens_details", None) or getattr(usage, "input_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None)
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return cached or 0
+
+
+class PromptCacheStats:
+    """
+    プロンプトキャッシュのヒット状況を集計する mixin。
+    system プロンプトとツール定義を常に先頭に置くことで、プロバイダ側のプレフィックスキャッシュが効く。
+    """
+    prompt_tokens: int = 0
+    cached_prompt_tokens: int = 0
+
+    def record_usage(self, response: Any) -> None:
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        self.prompt_tokens += getattr(usage, "prompt_tokens", None) or getattr(usage, "input_tokens", None) or 0
+        self.cached_prompt_tokens += _cached_prompt_tokens(usage)
+
+    @property
+    def cache_hit_rate(self) -> float:
+        if self.prompt_tokens == 0:
+            return 0.0
+        return self.cached_prompt_tokens / self.prompt_tokens
+
+
+class OpenAI(PromptCacheStats, Agent):
+    # chat_many で同時に送るリクエストの最大数
+    max_concurrency = 8
+    # True にすると chat() は Responses API を使い、previous_response_id で会話を続けて履歴の再送を省く
+    use_responses_api = False
 
-class OpenAI(Agent):
     def __init__(self, model, system_prompt, reasoning_effort=None):
         self.model = model
         self.system_prompt = system_prompt
         self._messages = [{"role": "system", "content": system_prompt}]
         # OpenAI 用に仮想的に用意された "async" 版インターフェースを想定
-        self.client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+        self.client = _client_for(None, OPENAI_API_KEY)
         self.reasoning_effort = reasoning_effort
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+        # Responses API の直前の応答 ID と、その時点の履歴の変更回数
+        self._last_response_id = None
+        self._synced_version = 0
+        # 履歴を追加・削除した回数。件数が同じでも中身が入れ替わったことを検出する
+        self._history_version = 0
+
+    def append_message(self, message: Dict):
+        super().append_message(message)
+        self._history_version += 1
+
+    def pop_message(self):
+        super().pop_message()
+        self._history_version += 1
+        # サーバー側の会話と手元の履歴が食い違うので、次の chat では履歴をすべて送る
+        self._last_response_id = None
 
     async def chat(self, message) -> str:
-        self._messages.append({"role": "user", "content": message})
+        if self.use_responses_api:
+            return await self._chat_responses(message)
+        self.append_message({"role": "user", "content": message})
         if self.reasoning_effort is None:
             response = await self.client.chat.completions.create(
                 model=self.model,
@@ -33,25 +159,118 @@ class OpenAI(Agent):
                 messages=self._messages,
                 reasoning_effort=self.reasoning_effort
             )
+        self.record_usage(response)
 
-        self._messages.append({
+        self.append_message({
             "role": "assistant",
             "content": response.choices[0].message.content
         })
         return response.choices[0].message.content
 
+    async def _chat_responses(self, message: str) -> str:
+        """
+        Responses API で chat する。
+        前回の応答以降に履歴が変わっていなければ previous_response_id を渡して新しいメッセージだけを送る。
+        そうでなければ (初回や chat 以外で履歴が増えた場合) 手元の履歴をすべて送る。
+        """
+        kwargs = {}
+        if self._last_response_id is not None and self._history_version == self._synced_version:
+            kwargs["previous_response_id"] = self._last_response_id
+            input_messages = []
+        else:
+            input_messages = [
+                {"role": m["role"], "content": m["content"]}
+                for m in self._messages
+                if m["role"] in ("user", "assistant") and isinstance(m.get("content"), str)
+            ]
+        if self.reasoning_effort is not None:
+            kwargs["reasoning"] = {"effort": self.reasoning_effort}
+        user_message = {"role": "user", "content": message}
+        self.append_message(user_message)
+        response = await self.client.responses.create(
+            model=self.model,
+            instructions=self.system_prompt,
+            input=[*input_messages, user_message],
+            **kwargs
+        )
+        self.record_usage(response)
+        self.append_message({"role": "assistant", "content": response.output_text})
+        self._last_response_id = response.id
+        self._synced_version = self._history_version
+        return response.output_text
+
+    async def chat_stream(self, message) -> AsyncIterator[str]:
+        """
+        chat のストリーミング版。生成されたテキストを届いた順に yield し、完了後に履歴へ追加する。
+        """
+        self.append_message({"role": "user", "content": message})
+        kwargs = {}
+        if self.reasoning_effort is not None:
+            kwargs["reasoning_effort"] = self.reasoning_effort
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=self._messages,
+            stream=True,
+            **kwargs
+        )
+        parts = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+        self.append_message({"role": "assistant", "content": "".join(parts)})
+
+    async def chat_many(self, messages: List[str]) -> List[str]:
+        """
+        複数のメッセージを並列に送り、応答を入力と同じ順で返す。
+        各リクエストは現在の履歴にメッセージを1件足したもので、履歴には追加しない。
+        """
+        base = list(self._messages)
+        kwargs = {}
+        if self.reasoning_effort is not None:
+            kwargs["reasoning_effort"] = self.reasoning_effort
+
+        async def one(message: str) -> str:
+            async with self._sem:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=[*base, {"role": "user", "content": message}],
+                    **kwargs
+                )
+            self.record_usage(response)
+            return response.choices[0].message.content
+
+        return list(await asyncio.gather(*(one(m) for m in messages)))
+
     @property
     def messages(self) -> List[Message]:
-        return [
-            Message(
-                role=m["role"],
-                content=m["content"]
-            ) for m in self._messages
-        ]
+        if self._dirty:
+            # 履歴は内部で作ったデータなので検証を省いて変換する
+            self._cached_messages = [
+                Message.model_construct(
+                    role=m["role"],
+                    content=m["content"]
+                ) for m in self._messages
+            ]
+            self._dirty = False
+        return self._cached_messages
 
 class OpenAIToolUse(OpenAI):
-    async def tool(self, message: str, tools: List[Dict[str, Any]])->Tuple[str,Dict[str,str]]:
-        self._messages.append({"role": "user", "content": message})
+    def __init__(self, model, system_prompt, reasoning_effort=None, tools: Optional[List[Dict[str, Any]]] = None):
+        super().__init__(model, system_prompt, reasoning_effort)
+        # tool() で tools を省略したときに使うツール定義
+        self.tools = tools
+
+    async def tool(self, message: str, tools: Optional[List[Dict[str, Any]]] = None)->Tuple[str,Dict[str,str]]:
+        if tools is None:
+            tools = self.tools
+        self.append_message({"role": "user", "content": message})
+        # 古いツール結果を切り詰めて、毎回送る履歴が際限なく大きくならないようにする
+        if prune_tool_messages(self._messages):
+            self._dirty = True
         if self.reasoning_effort is None:
             response = await self.client.chat.completions.create(
                 model=self.model,
@@ -65,77 +284,279 @@ class OpenAIToolUse(OpenAI):
                 reasoning_effort=self.reasoning_effort,
                 tools=tools
             )
-        self._messages.append(response.choices[0].message.model_dump())
+        self.record_usage(response)
+        self.append_message(response.choices[0].message.model_dump())
         message = response.choices[0].message.content
         tool_calls = response.choices[0].message.tool_calls
         return message, tool_calls
 
-class DeepSeek(Agent):
+class DeepSeek(PromptCacheStats, Agent):
+    # 保持する履歴の最大件数 (system プロンプトを除く)。None なら制限しない。
+    # 指定した場合は古いものから捨てるが、タスクの指示である最初の user メッセージは常に送る
+    max_history: Optional[int] = None
+    # chat_many で同時に送るリクエストの最大数
+    max_concurrency = 8
+
     def __init__(self, model, system_prompt):
         self.model = model
         self.system_prompt = system_prompt
-        self._messages = [{"role": "system", "content": system_prompt}]
+        self._system = {"role": "system", "content": system_prompt}
+        self._history = deque(maxlen=self.max_history)
+        # 最初の user メッセージ。履歴から押し出されても _request_messages で先頭に残す
+        self._first_user: Optional[Dict] = None
         # DeepSeek 用に仮想的に用意された "async" 版インターフェースを想定
-        self.client = AsyncOpenAI(api_key=DEEP_SEEK_API_KEY, base_url="https://api.deepseek.com")
+        self.client = _client_for("https://api.deepseek.com", DEEP_SEEK_API_KEY)
+        # LLM_CACHE=1 のときは同じ入力に対するレスポンスを再利用する
+        self.cache = default_cache if LLM_CACHE_ENABLED else None
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+
+    def append_message(self, message: Dict):
+        if self._first_user is None and message.get("role") == "user":
+            self._first_user = message
+        self._history.append(message)
+        self._dirty = True
+
+    def pop_message(self):
+        if self._history.pop() is self._first_user:
+            self._first_user = None
+        self._dirty = True
+
+    def _request_messages(self) -> List[Dict[str, Any]]:
+        """
+        API に送るメッセージのリストを作る。
+        古い履歴が押し出されて先頭に対応する tool_calls のない tool メッセージが残った場合は除く。
+        max_history で最初の user メッセージが押し出されている場合は、system プロンプトの直後に戻す。
+        """
+        history = list(self._history)
+        start = 0
+        while start < len(history) and history[start].get("role") == "tool":
+            start += 1
+        history = history[start:]
+        first = self._first_user
+        if self._history.maxlen is not None and first is not None and all(m is not first for m in history):
+            history.insert(0, first)
+        return [self._system, *history]
+
+    async def _create(
+        self,
+        tools: Optional[List[Dict[str, Any]]] = None,
+        messages: Optional[List[Dict[str, Any]]] = None,
+    ) -> ChatCompletion:
+        """
+        現在の履歴 (messages を指定した場合はそれ) で chat.completions.create を呼び出す。
+        キャッシュが有効な場合は (model, messages, tools) が同じレスポンスをキャッシュから返す。
+        """
+        if messages is None:
+            messages = self._request_messages()
+        kwargs = {"model": self.model, "messages": messages}
+        if tools is not None:
+            kwargs["tools"] = tools
+        key = None
+        if self.cache is not None:
+            key = make_cache_key(self.model, messages, tools)
+            cached = await self.cache.get(key)
+            if cached is not None:
+                return ChatCompletion.model_validate(cached)
+        response = await self.client.chat.completions.create(**kwargs)
+        self.record_usage(response)
+        if key is not None:
+            await self.cache.set(key, response.model_dump())
+        return response
 
     async def chat(self, message) -> str:
-        self._messages.append({"role": "user", "content": message})
+        self.append_message({"role": "user", "content": message})
         # 非同期版
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=self._messages,
-        )
-        self._messages.append({
+        response = await self._create()
+        self.append_message({
             "role": "assistant",
             "content": response.choices[0].message.content
         })
         return response.choices[0].message.content
 
+    async def chat_stream(self, message) -> AsyncIterator[str]:
+        """
+        chat のストリーミング版。生成されたテキストを届いた順に yield し、完了後に履歴へ追加する。
+        """
+        self.append_message({"role": "user", "content": message})
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=self._request_messages(),
+            stream=True
+        )
+        parts = []
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+        self.append_message({"role": "assistant", "content": "".join(parts)})
+
+    async def chat_many(self, messages: List[str]) -> List[str]:
+        """
+        複数のメッセージを並列に送り、応答を入力と同じ順で返す。
+        各リクエストは現在の履歴にメッセージを1件足したもので、履歴には追加しない。
+        """
+        base = self._request_messages()
+
+        async def one(message: str) -> str:
+            async with self._sem:
+                response = await self._create(messages=[*base, {"role": "user", "content": message}])
+            return response.choices[0].message.content
+
+        return list(await asyncio.gather(*(one(m) for m in messages)))
+
     @property
     def messages(self) -> List[Message]:
-        return [
-            Message(
-                role=m["role"],
-                content=m["content"]
-            ) for m in self._messages
-        ]
+        if self._dirty:
+            self._cached_messages = [
+                Message.model_construct(
+                    role=m["role"],
+                    content=m["content"]
+                ) for m in self._request_messages()
+            ]
+            self._dirty = False
+        return self._cached_messages
 
 class DeepSeekToolUse(DeepSeek):
-    async def tool(self, message: str, tools: List[Dict[str, Any]])->Tuple[str,Dict[str,str]]:
-        self._messages.append({"role": "user", "content": message})
+    def __init__(self, model, system_prompt, tools: Optional[List[Dict[str, Any]]] = None):
+        super().__init__(model, system_prompt)
+        # tool() で tools を省略したときに使うツール定義
+        self.tools = tools
+
+    async def tool(self, message: str, tools: Optional[List[Dict[str, Any]]] = None)->Tuple[str,Dict[str,str]]:
+        if tools is None:
+            tools = self.tools
+        self.append_message({"role": "user", "content": message})
+        # 古いツール結果を切り詰めて、毎回送る履歴が際限なく大きくならないようにする
+        if prune_tool_messages(self._history):
+            self._dirty = True
         # 非同期版
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=self._messages,
-            tools=tools
-        )
-        self._messages.append(response.choices[0].message.model_dump())
+        response = await self._create(tools)
+        self.append_message(response.choices[0].message.model_dump())
         message = response.choices[0].message.content
         tool_calls = response.choices[0].message.tool_calls
         return message, tool_calls
 
+class CachingAgent(Agent):
+    """
+    agent の chat() の前に SemanticCache を引き、似たプロンプトへの応答があればそれを返す。
+    会話の文脈は照合に含めないので、単発の質問を繰り返すような用途に使う。
+    キャッシュにヒットした場合、元の agent の履歴には追加されない。
+    """
+    def __init__(self, agent: Agent, cache: Optional[SemanticCache] = None, embedding_model: str = "text-embedding-3-small"):
+        self.agent = agent
+        self.cache = cache if cache is not None else SemanticCache()
+        self.embedding_model = embedding_model
+        self.client = _client_for(None, OPENAI_API_KEY)
+
+    async def _embed(self, texts: List[str]) -> List[List[float]]:
+        response = await self.client.embeddings.create(model=self.embedding_model, input=texts)
+        return [d.embedding for d in response.data]
+
+    async def chat(self, message: str) -> str:
+        [vector] = await self._embed([message])
+        cached = await self.cache.get(vector)
+        if cached is not None:
+            return cached
+        response = await self.agent.chat(message)
+        await self.cache.set(vector, message, response)
+        return response
+
+    async def chat_many(self, messages: List[str]) -> List[str]:
+        """
+        埋め込みは1回の API 呼び出しでまとめて計算し、キャッシュにないものだけ agent に並列で送る。
+        """
+        if not messages:
+            return []
+        vectors = await self._embed(messages)
+        results = [await self.cache.get(v) for v in vectors]
+        misses = [i for i, r in enumerate(results) if r is None]
+        if misses:
+            responses = await self.agent.chat_many([messages[i] for i in misses])
+            for i, response in zip(misses, responses):
+                results[i] = response
+                await self.cache.set(vectors[i], messages[i], response)
+        return results
+
+    @property
+    def messages(self) -> List[Message]:
+        return self.agent.messages
+
 class Gemini(Agent):
-    def __init__(self, model, system_prompt):
+    # chat_many で同時に送るリクエストの最大数
+    max_concurrency = 8
+
+    def __init__(self, model, system_prompt, cache_ttl: Optional[datetime.timedelta] = None):
+        """
+        cache_ttl を指定すると system プロンプトを CachedContent として登録し、毎回の送信を省く。
+        CachedContent には最小トークン数があるため、長い system プロンプトのときだけ指定する。
+        """
         genai.configure(api_key=GEMINI_API_KEY)
-        self.model = genai.GenerativeModel(
-            model_name=model,system_instruction=system_prompt
-        )
+        if cache_ttl is None:
+            self.model = genai.GenerativeModel(
+                model_name=model,system_instruction=system_prompt
+            )
+        else:
+            cached = genai.caching.CachedContent.create(
+                model=model, system_instruction=system_prompt, ttl=cache_ttl
+            )
+            self.model = genai.GenerativeModel.from_cached_content(cached)
+        self.model_name = model
         self._messages = []
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+        # CachedContent から読まれた入力トークン数の累計
+        self.cached_tokens = 0
+        # ローカルのトークナイザー。使えない場合は None で、count_tokens は API を呼ぶ
+        self._tokenizer = None
+        if sentencepiece is not None and GEMINI_TOKENIZER_PATH:
+            self._tokenizer = _load_tokenizer(GEMINI_TOKENIZER_PATH)
 
     async def chat(self, message: str) -> str:
         self.append_message({"role": "user", "content": message})
         
         response = await self.model.generate_content_async(message)
         response_text = response.text
+        self.cached_tokens += getattr(response.usage_metadata, "cached_content_token_count", 0) or 0
         
         self.append_message({"role": "assistant", "content": response_text})
         return response_text
 
+    async def chat_stream(self, message: str) -> AsyncIterator[str]:
+        """
+        chat のストリーミング版。生成されたテキストを届いた順に yield し、完了後に履歴へ追加する。
+        """
+        self.append_message({"role": "user", "content": message})
+        response = await self.model.generate_content_async(message, stream=True)
+        parts = []
+        async for chunk in response:
+            if chunk.text:
+                parts.append(chunk.text)
+                yield chunk.text
+        self.append_message({"role": "assistant", "content": "".join(parts)})
+
+    async def chat_many(self, messages: List[str]) -> List[str]:
+        """
+        複数のメッセージを並列に送り、応答を入力と同じ順で返す。履歴には追加しない。
+        """
+        async def one(message: str) -> str:
+            async with self._sem:
+                response = await self.model.generate_content_async(message)
+            return response.text
+
+        return list(await asyncio.gather(*(one(m) for m in messages)))
+
     @property
     def messages(self) -> List[Message]:
-        return [Message(role=m["role"], content=m["content"]) for m in self._messages]
+        if self._dirty:
+            self._cached_messages = [Message.model_construct(role=m["role"], content=m["content"]) for m in self._messages]
+            self._dirty = False
+        return self._cached_messages
 
     async def count_tokens(self, text: str) -> int:
+        if self._tokenizer is not None:
+            return len(self._tokenizer.encode(text, out_type=int))
         response = await self.model.count_tokens_async(text)
         return response.total_tokens
 
@@ -146,109 +567,43 @@ class Gemini(Agent):
         return response.text, response.usage_metadata
 
 
-class GeminiToolUse(Gemini):
-    async def tool(self, message: str, tools: List[Dict[str, Any]]) ->Tuple[str,Dict[str,str]]:
-        # ツール情報をプロンプトに組み込む
-        tool_descriptions = "\n".join([
-            f"- {tool['function']['name']}: {tool['function']['description']}"
-            for tool in tools
-        ])
-        
-        prompt = f"""
-        ユーザーメッセージ: {message}
-
-        利用可能なツール:
-        {tool_descriptions}
-
-        指示: 上記のメッセージに対して適切なツールを選択し、使用してください。ツールを使用する場合は、以下の形式で応答してください：
-
-        ツール使用:
-        """ + """
-        ```
-[{
-    "name": "ツール名",
-    "arguments": {{
-        "arg1": "値1",
-        "arg2": "値2"
-    }}
-},...]
-```
-""" + """
-
-        ツールを使用しない場合は、通常の応答を行ってください。複数のツールを使用する場合は、それぞれのツール使用を別々に記述してください。
-        """
-
-        response = await self.model.generate_content_async(prompt)
-        response_text = response.text
-
-        # ツール使用の応答をパースする
-        tool_uses = []
-        tool_use_texts = response_text.split("ツール使用:")
-        for tool_use_text in tool_use_texts[1:]:
-            json_text = tool_use_text[tool_use_text.index("```")+1:tool_use_text.index("```")].strip()
-            print(json_text)
-            tool_use = json.loads(json_text)
-            tool_uses += tool_use
-        self.append_message({"role": "user", "content": message})
-        self.append_message({"role": "assistant", "content": response_text})
-        return response_text, tool_uses
-
-    async def generate_content_with_tools(self, prompt: str, tools: List[Dict[str, Any]], config: GenerationConfig = None) -> tuple:
-        if config is None:
-            config = GenerationConfig()
-        response = await self.tool(prompt, tools)
-        # Note: Gemini APIは現在、ツール使用に関する詳細な使用量メタデータを提供していないため、
-        # ここでは簡易的な情報を返します。
-        usage_metadata = {
-            "prompt_token_count": await self.count_tokens(prompt),
-            "response_token_count": await self.count_tokens(response)
-        }
-        return response, usage_metadata
-
 class Function(BaseModel):
   name: str
-  arguments: str
+  # JSON 文字列に戻さず dict のまま持つ (LLMToolManager.exec は dict も受け付ける)
+  arguments: Dict[str, Any] = {}
 
 class FunctionTool(BaseModel):
     id: str
     function: Function
 class GeminiToolUse(Gemini):
-    async def tool(self, message: str, tools: List[Dict[str, Any]]) ->Tuple[str,Dict[str,str]]:
-        # ツール情報をプロンプトに組み込む
-        tool_descriptions = "\n".join([
-            f"- {tool['function']['name']}: {tool['function']['description']}"
-            for tool in tools
-        ])
-        
-        prompt = f"""
-        ユーザーメッセージ: {message}
-
-        利用可能なツール:
-        {tool_descriptions}
-
-        指示: 上記のメッセージに対して適切なツールを選択し、1つだけ使用してください。ツールを使用する場合は、以下の形式で応答してください.直接Pythonのjson.loadsでパースできるように余計な文字は入れないでPythonのdict形式で出力してください.変数を埋め込まないで直接値を入れて。いきなりすべてを行わずに細かく実行して。：
-        """ + """
-        ```{
-    "name": "ツール名",
-    "arguments": {{
-        "arg1": "値1",
-        "arg2": "値2"
-    }}
-}```""" + """
+    # 直前に使ったツール定義とその説明文。同じ tools で続けて呼ばれたときは説明文を作り直さない
+    _described_tools = None
+    _described_text = ""
+
+    def _tool_descriptions(self, tools: List[Dict[str, Any]]) -> str:
+        if tools is not self._described_tools:
+            self._described_text = "\n".join(
+                f"- {tool['function']['name']}: {tool['function']['description']}"
+                for tool in tools
+            )
+            self._described_tools = tools
+        return self._described_text
 
-        ツールを使用しない場合は、通常の応答を行ってください。複数のツールを使用する場合は、それぞれのツール使用を別々に記述してください。
-        """
+    async def tool(self, message: str, tools: List[Dict[str, Any]]) ->Tuple[str,Dict[str,str]]:
+        prompt = (
+            f"{_GEMINI_TOOL_INSTRUCTIONS}\n\n"
+            f"利用可能なツール:\n{self._tool_descriptions(tools)}\n\n"
+            f"ユーザーメッセージ: {message}"
+        )
 
         response = await self.model.generate_content_async(prompt)
         response_text = response.text
         # ツール使用の応答をパースする
         tool_uses = []
-        tool_use_text = response_text[response_text.index("{"):].strip()
-        json_text = tool_use_text[:tool_use_text.rindex("}")+1]
-        print(json_text)
-        tool_use = json.loads(json_text)
-        tool_use["arguments"] = json.dumps(tool_use["arguments"])
-        tool_uses.append(tool_use)
+        json_text = extract_json_object(response_text)
+        if json_text is not None:
+            print(json_text)
+            tool_uses.append(fast_loads(json_text))
         self.append_message({"role": "user", "content": message})
         self.append_message({"role": "assistant", "content": response_text})
         return response_text, [FunctionTool(id=str(uuid.uuid4()), function=Function(**f)) for f in tool_uses]
@@ -256,11 +611,17 @@ class GeminiToolUse(Gemini):
     async def generate_content_with_tools(self, prompt: str, tools: List[Dict[str, Any]], config: GenerationConfig = None) -> tuple:
         if config is None:
             config = GenerationConfig()
-        response = await self.tool(prompt, tools)
+        # プロンプトのトークン数は生成と並行して数えておく
+        prompt_token_count = asyncio.create_task(self.count_tokens(prompt))
+        try:
+            response = await self.tool(prompt, tools)
+        except BaseException:
+            prompt_token_count.cancel()
+            raise
         # Note: Gemini APIは現在、ツール使用に関する詳細な使用量メタデータを提供していないため、
         # ここでは簡易的な情報を返します。
         usage_metadata = {
-            "prompt_token_count": await self.count_tokens(prompt),
-            "response_token_count": await self.count_tokens(response)
+            "prompt_token_count": await prompt_token_count,
+            "response_token_count": await self.count_tokens(response[0])
         }
         return response, usage_metadata
\ No newline at end of file
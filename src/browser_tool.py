@@ -4,13 +4,139 @@ from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from webdriver_manager.chrome import ChromeDriverManager
 from .function_call import doc
+import re
+import functools
+import threading
+import contextlib
 import html2text
 
-class BrowserTool:
-    def __init__(self):
+try:
+    from selectolax.lexbor import LexborHTMLParser as HTMLParser
+except ImportError:  # selectolax が無い環境では html2text にフォールバックする
+    HTMLParser = None
+
+_BLOCK_TAGS = {
+    "p", "div", "section", "article", "header", "footer", "main", "nav", "aside",
+    "table", "tr", "ul", "ol", "dl", "dt", "dd", "blockquote", "form", "figure",
+}
+_HEADING_LEVELS = {f"h{i}": i for i in range(1, 7)}
+
+
+def html_to_markdown(html_content: str, use_html2text: bool = False) -> str:
+    """
+    HTML をマークダウンに変換する。
+    selectolax があれば C 実装のパーサーで1回だけパースし、見出し・リスト・リンク・コードだけを変換する。
+    use_html2text が True か selectolax が無い場合は html2text を使う。
+    """
+    if use_html2text or HTMLParser is None:
+        return html2text.html2text(html_content)
+
+    tree = HTMLParser(html_content)
+    tree.strip_tags(["script", "style", "noscript", "svg", "head"])
+    parts = []
+    # <pre> の中身は空白を保ったまま最後に差し戻す
+    preformatted = []
+
+    def walk(node):
+        for child in node.iter(include_text=True):
+            tag = child.tag
+            if tag == "-text":
+                text = child.text(deep=False)
+                if text:
+                    parts.append(re.sub(r"\s+", " ", text))
+            elif tag in _HEADING_LEVELS:
+                parts.append("\n\n" + "#" * _HEADING_LEVELS[tag] + " ")
+                walk(child)
+                parts.append("\n\n")
+            elif tag == "li":
+                parts.append("\n* ")
+                walk(child)
+            elif tag == "a":
+                href = child.attributes.get("href")
+                if href:
+                    parts.append("[")
+                    walk(child)
+                    parts.append(f"]({href})")
+                else:
+                    walk(child)
+            elif tag == "img":
+                src = child.attributes.get("src")
+                if src:
+                    parts.append(f"![{child.attributes.get('alt') or ''}]({src})")
+            elif tag == "br":
+                parts.append("\n")
+            elif tag == "pre":
+                parts.append(f"\n\n\x00{len(preformatted)}\x00\n\n")
+                preformatted.append("```\n" + child.text(deep=True).strip("\n") + "\n```")
+            elif tag in ("td", "th"):
+                walk(child)
+                parts.append(" ")
+            elif tag in _BLOCK_TAGS:
+                parts.append("\n\n")
+                walk(child)
+                parts.append("\n\n")
+            else:
+                walk(child)
+
+    walk(tree.body if tree.body is not None else tree.root)
+    lines = [line.strip() for line in "".join(parts).splitlines()]
+    markdown = re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip() + "\n"
+    return re.sub(r"\x00(\d+)\x00", lambda m: preformatted[int(m.group(1))], markdown)
+
+
+# プロセス全体で共有する Chrome。BrowserTool のインスタンスごとにタブを1つ割り当てる
+_driver = None
+# WebDriver はスレッドセーフではないので、タブの切り替えと操作はこのロックで直列化する
+_driver_lock = threading.RLock()
+# 共有の Chrome で現在アクティブなタブ。同じタブなら切り替えのリクエストを省く
+_active_handle = None
+
+
+@functools.lru_cache(maxsize=1)
+def _driver_path() -> str:
+    """
+    ChromeDriver のパス。バージョン確認のディスク・ネットワークアクセスはプロセスで1回だけにする。
+    """
+    return ChromeDriverManager().install()
+
+
+def _shared_driver() -> webdriver.Chrome:
+    """
+    共有の Chrome を返す。まだ起動していなければ起動する。_driver_lock を取得した状態で呼ぶ。
+    """
+    global _driver
+    if _driver is None:
         options = Options()
         options.add_argument('--headless')  # Run in headless mode.
-        self.driver = webdriver.Chrome(service=ChromeService(ChromeDriverManager().install()), options=options)
+        _driver = webdriver.Chrome(service=ChromeService(_driver_path()), options=options)
+    return _driver
+
+
+class BrowserTool:
+    # True にすると従来どおり html2text でマークダウンに変換する
+    use_html2text = False
+
+    def __init__(self):
+        global _active_handle
+        with _driver_lock:
+            is_new = _driver is None
+            self.driver = _shared_driver()
+            if not is_new:
+                # 既に起動済みの Chrome に自分用のタブを開く
+                self.driver.switch_to.new_window('tab')
+            self._handle = _active_handle = self.driver.current_window_handle
+
+    @contextlib.contextmanager
+    def _tab(self):
+        """
+        ロックを取得して自分のタブに切り替え、ドライバを返す。
+        """
+        global _active_handle
+        with _driver_lock:
+            if _active_handle != self._handle:
+                self.driver.switch_to.window(self._handle)
+                _active_handle = self._handle
+            yield self.driver
 
     @doc({
         "description": "現在のページのHTMLを返します。",
@@ -19,7 +145,8 @@ class BrowserTool:
     })
     def get(self) -> str:
         try:
-            return self.driver.page_source
+            with self._tab() as driver:
+                return driver.page_source
         except Exception as e:
             raise Exception(f"ページの取得に失敗しました: {e}")
 
@@ -30,8 +157,9 @@ class BrowserTool:
     })
     def get_markdown(self) -> str:
         try:
-            html_content = self.driver.page_source
-            markdown_content = html2text.html2text(html_content)
+            with self._tab() as driver:
+                html_content = driver.page_source
+            markdown_content = html_to_markdown(html_content, self.use_html2text)
             return markdown_content
         except Exception as e:
             raise Exception(f"ページの取得に失敗しました: {e}")
@@ -43,9 +171,10 @@ class BrowserTool:
     })
     def fetch_markdown(self, url: str) -> str:
         try:
-            self.driver.get(url)
-            html_content = self.driver.page_source
-            markdown_content = html2text.html2text(html_content)
+            with self._tab() as driver:
+                driver.get(url)
+                html_content = driver.page_source
+            markdown_content = html_to_markdown(html_content, self.use_html2text)
             return markdown_content
         except Exception as e:
             raise Exception(f"ページ '{url}' の取得に失敗しました: {e}")
@@ -57,8 +186,9 @@ class BrowserTool:
     })
     def fetch(self, url: str) -> str:
         try:
-            self.driver.get(url)
-            return self.driver.page_source
+            with self._tab() as driver:
+                driver.get(url)
+                return driver.page_source
         except Exception as e:
             raise Exception(f"ページ '{url}' の取得に失敗しました: {e}")
 
@@ -72,8 +202,9 @@ class BrowserTool:
     })
     def click(self, by: str, value: str) -> bool:
         try:
-            element = self.driver.find_element(by=By(by), value=value)
-            element.click()
+            with self._tab() as driver:
+                element = driver.find_element(by=By(by), value=value)
+                element.click()
             return True
         except Exception as e:
             raise Exception(f"要素 '{value}' のクリックに失敗しました: {e}")
@@ -88,8 +219,9 @@ class BrowserTool:
     })
     def get_element_text(self, by: str, value: str) -> str:
         try:
-            element = self.driver.find_element(by=By(by), value=value)
-            return element.text
+            with self._tab() as driver:
+                element = driver.find_element(by=By(by), value=value)
+                return element.text
         except Exception as e:
             raise Exception(f"要素 '{value}' のテキスト取得に失敗しました: {e}")
 
@@ -99,8 +231,20 @@ class BrowserTool:
         "returns": "ブラウザが正常に閉じたかどうか。",
     })
     def close(self) -> bool:
+        global _driver, _active_handle
         try:
-            self.driver.quit()
+            with _driver_lock:
+                if len(self.driver.window_handles) > 1:
+                    # 他のインスタンスが使っているので自分のタブだけ閉じる
+                    with self._tab() as driver:
+                        driver.close()
+                    _active_handle = self.driver.window_handles[0]
+                    self.driver.switch_to.window(_active_handle)
+                else:
+                    self.driver.quit()
+                    if _driver is self.driver:
+                        _driver = None
+                        _active_handle = None
             return True
         except Exception as e:
             raise Exception(f"ブラウザの終了に失敗しました: {e}")
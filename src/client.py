@@ -1,17 +1,47 @@
-import os
+import time
 import openai
+import httpx
 import anthropic
 import google.generativeai as genai
-from typing import List, Dict, Any, Optional
-from pydantic import BaseModel
+from google.generativeai.types import GenerationConfig
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+from pydantic import BaseModel, ValidationError
 
 from .prompt import JSON_PARSER_PROMPT
 from .type import Command, Agent, Message, CodeGenerator
 from .secret import OPENAI_API_KEY, DEEP_SEEK_API_KEY, GEMINI_API_KEY
+from .utils import fast_dumps, fast_loads, HTTP2_AVAILABLE
 
 
-def call_openai_structured_api(model: str, messages: List[dict], response_format: BaseModel):
-    response = openai.beta.chat.completions.parse(
+# (api_key, base_url) ごとに共有する同期版 OpenAI クライアント
+_sync_clients: Dict[Tuple[str, Optional[str]], openai.OpenAI] = {}
+
+
+def get_sync_client(api_key: str, base_url: Optional[str] = None) -> openai.OpenAI:
+    """
+    (api_key, base_url) ごとに openai.OpenAI クライアントを1つだけ作って共有する。
+    モジュールグローバルの openai.api_key を書き換えずに済み、コネクションも使い回せる。
+    """
+    key = (api_key, base_url)
+    client = _sync_clients.get(key)
+    if client is None:
+        http_client = httpx.Client(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_keepalive_connections=50),
+            timeout=httpx.Timeout(600.0, connect=5.0),
+        )
+        client = _sync_clients[key] = openai.OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+    return client
+
+
+# JSON モードで Command を直接出力させるときに system プロンプトの末尾に付ける指示
+COMMAND_JSON_INSTRUCTION = "\n\nOutput format is JSON. schema is\n\n" + fast_dumps(Command.model_json_schema())
+
+
+def call_openai_structured_api(model: str, messages: List[dict], response_format: BaseModel, client: Optional[openai.OpenAI] = None):
+    if client is None:
+        client = get_sync_client(OPENAI_API_KEY)
+    response = client.beta.chat.completions.parse(
         model=model,
         messages=messages,
         response_format=response_format,
@@ -23,11 +53,11 @@ class OpenAI(Agent):
         self.system_prompt = system_prompt
         self._messages = [{"role": "system", "content": system_prompt}]
         # OpenAI 用に仮想的に用意された "async" 版インターフェースを想定
-        self.client = openai.OpenAI(api_key=OPENAI_API_KEY)
+        self.client = get_sync_client(OPENAI_API_KEY)
         self.reasoning_effort = reasoning_effort
 
     def chat(self, message) -> str:
-        self._messages.append({"role": "user", "content": message})
+        self.append_message({"role": "user", "content": message})
         if self.reasoning_effort is None:
             response = self.client.chat.completions.create(
                 model=self.model,
@@ -40,20 +70,48 @@ class OpenAI(Agent):
                 reasoning_effort=self.reasoning_effort
             )
 
-        self._messages.append({
+        self.append_message({
             "role": "assistant",
             "content": response.choices[0].message.content
         })
         return response.choices[0].message.content
 
+    def chat_stream(self, message) -> Iterator[str]:
+        """
+        chat のストリーミング版。生成されたテキストを届いた順に yield し、完了後に履歴へ追加する。
+        """
+        self.append_message({"role": "user", "content": message})
+        kwargs = {}
+        if self.reasoning_effort is not None:
+            kwargs["reasoning_effort"] = self.reasoning_effort
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=self._messages,
+            stream=True,
+            **kwargs
+        )
+        parts = []
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+        self.append_message({"role": "assistant", "content": "".join(parts)})
+
     @property
     def messages(self) -> List[Message]:
-        return [
-            Message(
-                role=m["role"],
-                content=m["content"]
-            ) for m in self._messages
-        ]
+        if self._dirty:
+            # 履歴は内部で作ったデータなので検証を省いて変換する
+            self._cached_messages = [
+                Message.model_construct(
+                    role=m["role"],
+                    content=m["content"]
+                ) for m in self._messages
+            ]
+            self._dirty = False
+        return self._cached_messages
 
 class CodeGeneratorOpenAI(CodeGenerator):
     OPEN_AI_MODELS = ["gpt-4o", "gpt-4o-mini", "o1-mini", "o1"]
@@ -61,32 +119,34 @@ class CodeGeneratorOpenAI(CodeGenerator):
         self.model = model
         self.system_prompt = system_prompt
         self._messages = [{"role": "system", "content": system_prompt}]
+        self.client = get_sync_client(OPENAI_API_KEY)
 
     def chat(self, message) -> str:
-        openai.api_key = OPENAI_API_KEY
-        self._messages.append({"role": "user", "content": message})
-        response = openai.chat.completions.create(
+        self.append_message({"role": "user", "content": message})
+        response = self.client.chat.completions.create(
             model=self.model,
             messages=self._messages
         )
-        self._messages.append({"role": "assistant", "content": response.choices[0].message.content})
+        self.append_message({"role": "assistant", "content": response.choices[0].message.content})
         return response.choices[0].message.content
 
     def code(self, message) -> Optional[Command]:
-        openai.api_key = OPENAI_API_KEY
-        self._messages.append({"role": "user", "content": message})
-        response = call_openai_structured_api(self.model, self._messages, Command)
-        self._messages.append({"role": "assistant", "content": response.choices[0].message.content})
+        self.append_message({"role": "user", "content": message})
+        response = call_openai_structured_api(self.model, self._messages, Command, self.client)
+        self.append_message({"role": "assistant", "content": response.choices[0].message.content})
         return response.choices[0].message.parsed
 
     @property
     def messages(self) -> List[Message]:
-        return [
-            Message(
-                role=m["role"],
-                content=m["content"]
-            ) for m in self._messages
-        ]
+        if self._dirty:
+            self._cached_messages = [
+                Message.model_construct(
+                    role=m["role"],
+                    content=m["content"]
+                ) for m in self._messages
+            ]
+            self._dirty = False
+        return self._cached_messages
 
 class DeepSeek(Agent):
 
@@ -94,46 +154,77 @@ class DeepSeek(Agent):
         self.model = model
         self.system_prompt = system_prompt
         self._messages = [{"role": "system", "content": system_prompt}]
-        self.client = openai.OpenAI(api_key=DEEP_SEEK_API_KEY, base_url="https://api.deepseek.com")
+        self.client = get_sync_client(DEEP_SEEK_API_KEY, "https://api.deepseek.com")
 
     def chat(self, message) -> str:
-        self._messages.append({"role": "user", "content": message})
+        self.append_message({"role": "user", "content": message})
         response = self.client.chat.completions.create(
             model=self.model,
             messages=self._messages,
         )
-        self._messages.append({"role": "assistant", "content": response.choices[0].message.content})
+        self.append_message({"role": "assistant", "content": response.choices[0].message.content})
         return response.choices[0].message.content
 
+    def chat_stream(self, message) -> Iterator[str]:
+        """
+        chat のストリーミング版。生成されたテキストを届いた順に yield し、完了後に履歴へ追加する。
+        """
+        self.append_message({"role": "user", "content": message})
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=self._messages,
+            stream=True
+        )
+        parts = []
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+        self.append_message({"role": "assistant", "content": "".join(parts)})
+
     @property
     def messages(self) -> List[Message]:
-        return [
-            Message(
-                role=m["role"],
-                content=m["content"]
-            ) for m in self._messages
-        ]
+        if self._dirty:
+            self._cached_messages = [
+                Message.model_construct(
+                    role=m["role"],
+                    content=m["content"]
+                ) for m in self._messages
+            ]
+            self._dirty = False
+        return self._cached_messages
 class CodeGeneratorDeepSeek(DeepSeek):
+    def __init__(self, model, system_prompt):
+        super().__init__(model, system_prompt)
+        # スキーマの指示は system プロンプトに1度だけ入れる。毎ターンの user メッセージに付けると履歴に溜まって毎回再送される
+        self._messages[0] = {"role": "system", "content": system_prompt + COMMAND_JSON_INSTRUCTION}
+
     def code(self, message) -> Optional[Command]:
-        self.chat(message)
-        openai.api_key = OPENAI_API_KEY
-        raw_message = self.messages[-1].content
-        messages = [
-            {"role": "system", "content": "You are JSON parser, don't rewrite content just parse it."},
-            {"role": "user", "content": "parse following.: \n" + raw_message},
-        ]
-        response = call_openai_structured_api("gpt-4o-mini", messages, Command)
-        return response.choices[0].message.parsed
+        """
+        JSON モードで Command を直接出力させる。gpt-4o-mini でのパースの呼び出しは不要。
+        """
+        self.append_message({"role": "user", "content": message})
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=self._messages,
+            response_format={"type": "json_object"},
+        )
+        content = response.choices[0].message.content
+        self.append_message({"role": "assistant", "content": content})
+        return Command.model_validate_json(content)
 
 class DeepSeekToolUse(DeepSeek):
     def tool(self, message: str, tools: List[Dict[str, Any]])->str:
-        self._messages.append({"role": "user", "content": message})
+        self.append_message({"role": "user", "content": message})
         response = self.client.chat.completions.create(
             model=self.model,
             messages=self._messages,
             tools=tools
         )
-        self._messages.append(response.choices[0].message.model_dump())
+        self.append_message(response.choices[0].message.model_dump())
         return response
 
 class Anthropic(Agent):
@@ -142,14 +233,19 @@ class Anthropic(Agent):
         self.client = anthropic.Anthropic()
         self.model = model
         self.system_prompt = system_prompt
+        # system プロンプトは毎回同じなのでプロンプトキャッシュの対象にする
+        self.system = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
         self._messages = []
+        # プロンプトキャッシュから読んだ / キャッシュに書き込んだ入力トークン数の累計
+        self.cache_read_tokens = 0
+        self.cache_creation_tokens = 0
         if self.model == "claude-3-5-sonnet-20241022":
             self.max_tokens = 4000
         else:
             self.max_tokens = 2000
 
     def chat(self, message) -> str:
-        self._messages.append({
+        self.append_message({
             "role": "user",
             "content": [
                 {
@@ -159,14 +255,17 @@ class Anthropic(Agent):
             ]
         })
         
+        self._mark_cache_breakpoint()
         response = self.client.messages.create(
             model=self.model,
-            system=self.system_prompt,
+            system=self.system,
             messages=self._messages,
             max_tokens=self.max_tokens
         )
+        self.cache_read_tokens += getattr(response.usage, "cache_read_input_tokens", None) or 0
+        self.cache_creation_tokens += getattr(response.usage, "cache_creation_input_tokens", None) or 0
         
-        self._messages.append({
+        self.append_message({
             "role": "assistant",
             "content": [
                 {
@@ -178,68 +277,241 @@ class Anthropic(Agent):
         
         return response.content[0].text
 
+    def chat_stream(self, message) -> Iterator[str]:
+        """
+        chat のストリーミング版。生成されたテキストを届いた順に yield し、完了後に履歴へ追加する。
+        """
+        self.append_message({"role": "user", "content": [{"type": "text", "text": message}]})
+        self._mark_cache_breakpoint()
+        parts = []
+        with self.client.messages.stream(
+            model=self.model,
+            system=self.system,
+            messages=self._messages,
+            max_tokens=self.max_tokens
+        ) as stream:
+            for text in stream.text_stream:
+                parts.append(text)
+                yield text
+            usage = stream.get_final_message().usage
+        self.cache_read_tokens += getattr(usage, "cache_read_input_tokens", None) or 0
+        self.cache_creation_tokens += getattr(usage, "cache_creation_input_tokens", None) or 0
+        self.append_message({"role": "assistant", "content": [{"type": "text", "text": "".join(parts)}]})
+
+    def _mark_cache_breakpoint(self):
+        """
+        最新のユーザーメッセージに cache_control を付け、それまでの履歴を次回のキャッシュ対象にする。
+        キャッシュの区切りは4つまでなので、古いメッセージに付けたものは外す。
+        """
+        for m in self._messages[:-1]:
+            if isinstance(m["content"], list):
+                m["content"][-1].pop("cache_control", None)
+        last = self._messages[-1]
+        if isinstance(last["content"], list):
+            last["content"][-1]["cache_control"] = {"type": "ephemeral"}
+
     @property
     def messages(self) -> List[Message]:
-        return [
-            Message(
-                role=m["role"],
-                content=m["content"][0]["text"] if isinstance(m["content"], list) else m["content"]
-            ) for m in self._messages
-        ]
+        if self._dirty:
+            self._cached_messages = [
+                Message.model_construct(
+                    role=m["role"],
+                    content=m["content"][0]["text"] if isinstance(m["content"], list) else m["content"]
+                ) for m in self._messages
+            ]
+            self._dirty = False
+        return self._cached_messages
 
 
 class CodeGeneratorAnthropic(Anthropic):
+    # Command を入力スキーマとするツール。tool_choice で必ずこれを呼ばせて構造化出力として使う
+    COMMAND_TOOL = {
+        "name": "Command",
+        "description": "Respond with the answer and the next action.",
+        "input_schema": Command.model_json_schema(),
+    }
+
     def code(self, message) -> Optional[Command]:
-        self.chat(message)
-        openai.api_key = OPENAI_API_KEY
-        raw_message = self.messages[-1].content
-        messages = [
-            {"role": "system", "content": "You are JSON parser, don't rewrite content just parse it."},
-            {"role": "user", "content": "parse following.: \n" + raw_message},
-        ]
-        response = call_openai_structured_api("gpt-4o-mini", messages, Command)
-        return response.choices[0].message.parsed
+        """
+        Command ツールの呼び出しを強制して Command を直接受け取る。gpt-4o-mini でのパースの呼び出しは不要。
+        """
+        self.append_message({"role": "user", "content": [{"type": "text", "text": message}]})
+        self._mark_cache_breakpoint()
+        response = self.client.messages.create(
+            model=self.model,
+            system=self.system,
+            messages=self._messages,
+            max_tokens=self.max_tokens,
+            tools=[self.COMMAND_TOOL],
+            tool_choice={"type": "tool", "name": "Command"},
+        )
+        self.cache_read_tokens += getattr(response.usage, "cache_read_input_tokens", None) or 0
+        self.cache_creation_tokens += getattr(response.usage, "cache_creation_input_tokens", None) or 0
+        tool_input = next(block.input for block in response.content if block.type == "tool_use")
+        # 次のターンで tool_result を返さずに済むよう、履歴にはテキストの JSON として残す
+        self.append_message({"role": "assistant", "content": [{"type": "text", "text": fast_dumps(tool_input)}]})
+        return Command.model_validate(tool_input)
 
 class Gemini(Agent):
     def __init__(self, model, system_prompt):
         self.model = genai.GenerativeModel(
             model_name=model,
             system_instruction=system_prompt,
-            api_key=os.environ.get("GEMINI_API_KEY")
+            api_key=GEMINI_API_KEY
         )
+        self.model_name = model
         self.system_prompt = system_prompt
         self._messages = []
 
     def chat(self, message) -> str:
-        self._messages.append({"role": "user", "content": message})
+        self.append_message({"role": "user", "content": message})
         response = self.model.generate_content(message)
         response_text = response.text
-        self._messages.append({"role": "assistant", "content": response_text})
+        self.append_message({"role": "assistant", "content": response_text})
         return response_text
 
+    def chat_stream(self, message) -> Iterator[str]:
+        """
+        chat のストリーミング版。生成されたテキストを届いた順に yield し、完了後に履歴へ追加する。
+        """
+        self.append_message({"role": "user", "content": message})
+        parts = []
+        for chunk in self.model.generate_content(message, stream=True):
+            if chunk.text:
+                parts.append(chunk.text)
+                yield chunk.text
+        self.append_message({"role": "assistant", "content": "".join(parts)})
+
     @property
     def messages(self) -> List[Message]:
-        return [
-            Message(
-                role=m["role"],
-                content=m["content"]
-            ) for m in self._messages
-        ]
+        if self._dirty:
+            self._cached_messages = [
+                Message.model_construct(
+                    role=m["role"],
+                    content=m["content"]
+                ) for m in self._messages
+            ]
+            self._dirty = False
+        return self._cached_messages
 
 class CodeGeneratorGemini(Gemini):
+    COMMAND_CONFIG = GenerationConfig(response_mime_type="application/json", response_schema=Command)
+
     def code(self, message) -> Optional[Command]:
-        self.chat(message)
-        
-        openai.api_key = GEMINI_API_KEY
-        if not openai.api_key:
-            raise ValueError("OPENAI_API_KEY environment variable is not set")
-            
-        raw_message = self.messages[-1].content
-        messages = [
-            {"role": "system", "content": JSON_PARSER_PROMPT},
-            {"role": "user", "content": "parse following.: \n" + raw_message},
-        ]
-        response = call_openai_structured_api("gpt-4o-mini", messages, Command)
-        return response.choices[0].message.parsed
+        """
+        response_schema を指定して Command の JSON を直接出力させる。gpt-4o-mini でのパースの呼び出しは不要。
+        """
+        self.append_message({"role": "user", "content": message})
+        response = self.model.generate_content(message, generation_config=self.COMMAND_CONFIG)
+        self.append_message({"role": "assistant", "content": response.text})
+        return Command.model_validate_json(response.text)
+
+
+class BatchCodeGenerator:
+    """
+    agent.chat() の自由形式の応答を Command にパースする処理を、OpenAI の Batch API でまとめて実行するラッパー。
+    応答は code() で agent から同期で受け取り、parser_model による構造化パースだけを collect() でバッチにして送る。
+    Batch API は料金が半額で別枠のレート制限が使えるが、結果は最大 24 時間後になるので対話しない一括処理向け。
+
+    例:
+        generator = BatchCodeGenerator(DeepSeek("deepseek-chat", SYSTEM_PROMPT))
+        for task in tasks:
+            generator.code(task)
+        commands = generator.collect()
+    """
+    def __init__(self, agent: Agent, parser_model: str = "gpt-4o-mini"):
+        self.agent = agent
+        self.parser_model = parser_model
+        self.client = get_sync_client(OPENAI_API_KEY)
+        self._pending: List[str] = []
+
+    def code(self, message) -> str:
+        """
+        agent で応答を生成し、そのパースをバッチに積む。パース結果は collect() で受け取る。
+
+        Returns:
+            str: バッチ内でこのリクエストを識別する custom_id
+        """
+        raw_message = self.agent.chat(message)
+        self._pending.append(raw_message)
+        return str(len(self._pending) - 1)
+
+    def submit_batch(self, raw_messages: List[str]) -> str:
+        """
+        raw_messages のパースリクエストを JSONL にまとめて Batch API に投入し、バッチ ID を返す。
+        custom_id は raw_messages のインデックス。
+        """
+        response_format = {
+            "type": "json_schema",
+            "json_schema": {"name": Command.__name__, "schema": Command.model_json_schema()},
+        }
+        lines = []
+        for i, raw_message in enumerate(raw_messages):
+            lines.append(fast_dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.parser_model,
+                    "messages": [
+                        {"role": "system", "content": JSON_PARSER_PROMPT},
+                        {"role": "user", "content": "parse following.: \n" + raw_message},
+                    ],
+                    "response_format": response_format,
+                },
+            }))
+        batch_file = self.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode()),
+            purpose="batch",
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    def wait_for_batch(self, batch_id: str, poll_interval: float = 30.0) -> List[Optional[Command]]:
+        """
+        バッチの完了を poll_interval 秒ごとに確認して待ち、custom_id 順に Command のリストを返す。
+        個別に失敗したリクエストは None になる。
+
+        Raises:
+            RuntimeError: バッチ自体が failed / expired / cancelled になった場合
+        """
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status == "completed":
+                break
+            if batch.status in ("failed", "expired", "cancelled"):
+                raise RuntimeError(f"Batch {batch_id} ended with status {batch.status}")
+            time.sleep(poll_interval)
+
+        results: Dict[int, Optional[Command]] = {}
+        if batch.output_file_id is not None:
+            for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                if not line:
+                    continue
+                record = fast_loads(line)
+                response = record.get("response") or {}
+                if response.get("status_code") != 200:
+                    continue
+                # 途中で切れた出力などでパースできないリクエストは、そのリクエストだけ None にする
+                try:
+                    content = response["body"]["choices"][0]["message"]["content"]
+                    results[int(record["custom_id"])] = Command.model_validate_json(content)
+                except (ValidationError, KeyError, IndexError, TypeError):
+                    continue
+        total = batch.request_counts.total if batch.request_counts else len(results)
+        return [results.get(i) for i in range(total)]
 
+    def collect(self, poll_interval: float = 30.0) -> List[Optional[Command]]:
+        """
+        code() で積んだパースをバッチで実行し、code() を呼んだ順に Command のリストを返す。
+        """
+        if not self._pending:
+            return []
+        raw_messages, self._pending = self._pending, []
+        batch_id = self.submit_batch(raw_messages)
+        return self.wait_for_batch(batch_id, poll_interval)
 
@@ -1,20 +1,44 @@
-from typing import Callable, Dict, Any
-from code import InteractiveInterpreter
+import io
+import hashlib
+import traceback
+import contextlib
+from types import CodeType
+from typing import Callable, Dict, Any, Optional
+
+_SNIPPET_FILENAME = "<tool>"
+
+
+def _snippet_lineno(exc: BaseException) -> Optional[int]:
+    """Return the line of the snippet where exc was raised, or None if it came from elsewhere."""
+    for frame in reversed(traceback.extract_tb(exc.__traceback__)):
+        if frame.filename == _SNIPPET_FILENAME:
+            return frame.lineno
+    return None
 
 class CodeInterpreter:
     """
     A minimal code agent that executes tool calls formulated in code format.
-    This agent executes code snippets independently without state persistence.
+    Snippets are executed in a shared namespace, so variables such as "state" persist between calls.
     """
     def __init__(self, functions: Dict[str, Callable]):
-        self.interpreter = InteractiveInterpreter()
-        for name, func in functions.items():
-            self.interpreter.locals[name] = func
+        self.namespace: Dict[str, Any] = {"__name__": "__console__", "__doc__": None}
+        self.namespace.update(functions)
+        self.namespace["state"] = {}
+        self._code_cache: Dict[bytes, CodeType] = {}  # Compiled snippets keyed by a hash of their source
         self.history = []  # To store the executed code and outputs
 
+    def _compile(self, code: str) -> CodeType:
+        key = hashlib.blake2b(code.encode(), digest_size=16).digest()
+        compiled = self._code_cache.get(key)
+        if compiled is None:
+            compiled = self._code_cache[key] = compile(code, _SNIPPET_FILENAME, "exec")
+        return compiled
+
     def parse_and_execute(self, code: str) -> Any:
         """
-        Parses and executes the given code independently.
+        Parses and executes the given code in the shared namespace.
+        Identical snippets are compiled only once. Syntax and runtime errors are
+        returned in the result instead of being printed.
 
         Args:
             code (str): Code input representing logic and tool usage.
@@ -23,24 +47,42 @@ class CodeInterpreter:
             Any: A dictionary containing a status message, any printed output, and state changes.
         """
         complete_code = code.strip()
+        output = io.StringIO()
         try:
-            self.interpreter.runcode(complete_code)
+            with contextlib.redirect_stdout(output):
+                exec(self._compile(complete_code), self.namespace)
             result = {
                 "status": "success",
                 "code": complete_code,
-                "state": self.interpreter.locals["state"],
+                "state": self.namespace.get("state"),
+                "output": output.getvalue(),
+            }
+        except SyntaxError as e:
+            result = {
+                "status": "error",
+                "code": complete_code,
+                "state": self.namespace.get("state"),
+                "output": output.getvalue(),
+                "message": e.msg,
+                "error_type": "SyntaxError",
+                "lineno": e.lineno,
+                "offset": e.offset,
             }
         except Exception as e:
             result = {
                 "status": "error",
                 "code": complete_code,
-                "state": self.interpreter.locals["state"],
+                "state": self.namespace.get("state"),
+                "output": output.getvalue(),
                 "message": str(e),
+                "error_type": type(e).__name__,
+                "lineno": _snippet_lineno(e),
             }
         self.history.append(result)
         return result
 if __name__ == "__main__":
-    from function_call import LLMToolManager
+    # Run as a module from the repository root: python -m src.code_interpreter
+    from src.function_call import LLMToolManager
     # Example initial tools setup for the agent
     def multiply_by_two(x: int) -> int:
         """
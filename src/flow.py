@@ -1,42 +1,88 @@
-import json
-import openai
+import re
+import shlex
+import asyncio
+import functools
 import subprocess
+from collections import deque
 from pydantic import BaseModel
-from typing import Generic, List, Dict, TypeVar
-from .client import call_openai_structured_api
-from .type import Command, Agent
+from typing import Any, Generic, List, Dict, Optional, TypeVar
+from .client import call_openai_structured_api, get_sync_client
+from .llm_cache import cached_llm_call, SemanticCache
 from .secret import OPENAI_API_KEY
+from .type import Command, Agent
+from .utils import fast_dumps, extract_json_object
+
+# シェルの解釈が必要な記法 (パイプ, リダイレクト, 変数展開, グロブ, 複数行, 環境変数の代入など)
+_SHELL_SYNTAX = re.compile(r"[|&;<>()$`*?\[\]{}~!#\n]|^\s*\w+=")
+
 
 class CodeInterpreterFlow:
+    # bash の実行結果として LLM に返す最大行数 (それより前の出力は捨てる)
+    MAX_OUTPUT_LINES = 200
+
+    @staticmethod
+    def _handle_wait(response: Command) -> str:
+        """ユーザから追加入力を受け取る。"""
+        # 先にエージェントの回答 (response.answer) があるなら表示
+        if response.answer:
+            print("Agent:", response.answer)
+        return input("次の指示を入力してください: ")
+
+    @staticmethod
+    def _handle_bash(response: Command) -> str:
+        """response.code を bash として実行し、その結果を返す。"""
+        cmd = response.code
+        # パイプやリダイレクトなどを含まない単純なコマンドはシェルを介さずに直接実行する
+        use_shell = _SHELL_SYNTAX.search(cmd) is not None
+        try:
+            args = cmd if use_shell else shlex.split(cmd)
+        except ValueError:
+            # 閉じていない引用符などはシェルにエラーを出させる
+            args, use_shell = cmd, True
+        # 出力を全部溜めずに1行ずつ読み、LLM に返す末尾 MAX_OUTPUT_LINES 行だけを保持する
+        try:
+            with subprocess.Popen(
+                args,
+                shell=use_shell,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,
+            ) as proc:
+                tail = deque(proc.stdout, maxlen=CodeInterpreterFlow.MAX_OUTPUT_LINES)
+        except OSError as e:
+            # シェルを介さない場合、コマンドが見つからないエラーは Popen の例外になる
+            return "実行結果です。\n" + f"{args[0]}: {e.strerror}\n"
+        return "実行結果です。\n" + "".join(tail)
+
+    @staticmethod
+    def _handle_answer(response: Command) -> str:
+        """単純に answer を返す。"""
+        return response.answer
+
+    # (action, language) -> 次のプロンプトを作る処理
+    # action が "wait" なら、ユーザから追加入力を受け取りたいケース
+    # action が "code" で language が "bash" なら、コードを実行した結果を返す
+    _HANDLERS = {
+        ("wait", None): _handle_wait,
+        ("code", "bash"): _handle_bash,
+    }
+
     @staticmethod
     def get_next_prompt(response: Command) -> str:
         """
         response の内容に応じて次のプロンプト文字列を生成する。
-        (副作用: input や subprocess.run を行う)
+        (副作用: input や subprocess.Popen を行う)
+        (action, language) で _HANDLERS から処理を選び、language を問わない処理は (action, None) で登録する。
         """
-        # action が "wait" なら、ユーザから追加入力を受け取りたいケース
-        if response.action == "wait":
-            # 先にエージェントの回答 (response.answer) があるなら表示
-            if response.answer:
-                print("Agent:", response.answer)
-            return input("次の指示を入力してください: ")
-
-        # action が "code" の場合は、response.code を bash として実行し、その結果を返す
-        if response.action == "code" and response.language == "bash":
-            cmd = response.code
-            result = subprocess.run(
-                cmd,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            if result.stderr:
-                return "実行結果です。\n" + result.stderr
-            return "実行結果です。\n" + result.stdout
-
-        # 上記以外の場合 (action が "answer" 等) は単純に answer を返す
-        return response.answer
+        handlers = CodeInterpreterFlow._HANDLERS
+        handler = (
+            handlers.get((response.action, response.language))
+            or handlers.get((response.action, None))
+            # 上記以外の場合 (action が "answer" 等) は単純に answer を返す
+            or CodeInterpreterFlow._handle_answer
+        )
+        return handler(response)
 
     @staticmethod
     def run(agent: Agent, purpose: str) -> str:
@@ -77,9 +123,21 @@ class CodeInterpreterFlow:
         return response.model_dump()
 
 
+
 def chat_prompts(agent, prompts):
+    res = None
     for prompt in prompts:
-        _ = agent.chat(prompt)
+        res = agent.chat(prompt)
+    return res
+
+async def achat_prompts(agent, prompts):
+    """
+    chat_prompts の非同期版 (async_client のエージェント用)。最後の応答を返す。
+    """
+    res = None
+    for prompt in prompts:
+        res = await agent.chat(prompt)
+    return res
 
 def flow(agents: List[Agent], prompt: str) -> List[str]:
     """
@@ -90,6 +148,18 @@ def flow(agents: List[Agent], prompt: str) -> List[str]:
         res = agent.chat(res)
     return res
 
+async def aflow(agents: List[Any], prompt: str, timeout: Optional[float] = None) -> str:
+    """
+    flow の非同期版 (async_client のエージェント用)。
+    各エージェントは前のエージェントの出力を入力にするので順番に実行するが、
+    待っている間もイベントループを止めないため、複数の aflow を asyncio.gather で同時に進められる。
+    timeout を指定すると1回の問い合わせがその秒数を超えたときに asyncio.TimeoutError を送出する。
+    """
+    res = prompt
+    for agent in agents:
+        res = await asyncio.wait_for(agent.chat(res), timeout)
+    return res
+
 class SelfRefineFlow:
     @staticmethod
     def run(agent: Agent, purpose: str, improve_prompt: str, improve_count: int) -> str:
@@ -97,9 +167,18 @@ class SelfRefineFlow:
         SelfRefineFlow のフロー（静的メソッド版）。
         """
         # 最初に purpose を問い合わせ
-        agent.chat(purpose)
+        res = agent.chat(purpose)
         # improve_count 回、improve_prompt を投げる
-        return chat_prompts(agent, improve_count * [improve_prompt])
+        return chat_prompts(agent, improve_count * [improve_prompt]) if improve_count else res
+
+    @staticmethod
+    async def arun(agent, purpose: str, improve_prompt: str, improve_count: int) -> str:
+        """
+        SelfRefineFlow の非同期版 (async_client のエージェント用)。
+        改善は前の回答を履歴に含めて行うので順番に問い合わせるが、待っている間もイベントループを止めない。
+        """
+        res = await agent.chat(purpose)
+        return await achat_prompts(agent, improve_count * [improve_prompt]) if improve_count else res
 
 class TreeFlow:
     @staticmethod
@@ -128,41 +207,129 @@ class TreeFlow:
         next_prompt = TreeFlow.merge_answers(answers, roles)
         # manager に渡して終了
         return manager.chat(next_prompt)
+
+    @staticmethod
+    async def arun(commander, agents: Dict[str, Any], manager, purpose) -> str:
+        """
+        TreeFlow の非同期版 (async_client のエージェント用)。
+        commander の応答を全エージェントに同時に渡し、各エージェントの回答を並行して待つ。
+        """
+        # commander に最初の目的を問い合わせ
+        response = await commander.chat(purpose)
+        # 各エージェントは互いの回答を待たないので、待ち時間は最も遅いエージェントの分だけになる
+        answers = await asyncio.gather(*(agent.chat(response) for agent in agents.values()))
+        # 回答の順序は agents の順序と同じ
+        next_prompt = TreeFlow.merge_answers(list(answers), list(agents.keys()))
+        # manager に渡して終了
+        return await manager.chat(next_prompt)
     
+@cached_llm_call
+def _parse_structured(model: str, messages: List[dict], response_format: type[BaseModel]) -> Optional[dict]:
+    """
+    Structured Outputs でパースした結果を dict で返す (LLM_CACHE=1 のときは同じ入力の結果を再利用する)。
+    モデルが応答を拒否した場合 (parsed が None) は None を返す。
+    """
+    response = call_openai_structured_api(model, messages, response_format)
+    parsed = response.choices[0].message.parsed
+    return parsed.model_dump() if parsed is not None else None
+
+
 FORMAT_T = TypeVar('FORMAT_T', bound=BaseModel)
 class FormatFlow(Generic[FORMAT_T]):
-    def __init__(self, model_class: type[FORMAT_T]):
+    def __init__(
+        self,
+        model_class: type[FORMAT_T],
+        semantic_cache: Optional[SemanticCache] = None,
+        embedding_model: str = "text-embedding-3-small",
+    ):
+        """
+        semantic_cache を指定すると、言い回しが違うだけの raw_message には保存済みのパース結果を返す。
+        キャッシュには model_class の JSON を保存するので、model_class ごとに別の SemanticCache を使うこと。
+        """
         self.model_class = model_class
-    
-    def format(self, raw_message: str) -> FORMAT_T:
-        openai.api_key = OPENAI_API_KEY
+        self.semantic_cache = semantic_cache
+        self.embedding_model = embedding_model
+
+    def _embed(self, text: str) -> List[float]:
+        response = get_sync_client(OPENAI_API_KEY).embeddings.create(model=self.embedding_model, input=[text])
+        return response.data[0].embedding
+
+    def format(self, raw_message: str) -> Optional[FORMAT_T]:
+        vector = None
+        if self.semantic_cache is not None:
+            vector = self._embed(raw_message)
+            cached = self.semantic_cache.get_sync(vector)
+            if cached is not None:
+                try:
+                    return self.model_class.model_validate_json(cached)
+                except ValueError:
+                    # 別の model_class の結果などは使わずにパースし直す
+                    pass
         messages = [
             {"role": "system", "content": "You are JSON parser, don't rewrite content just parse it."},
             {"role": "user", "content": "parse following.: \n" + raw_message},
         ]
-        response = call_openai_structured_api("gpt-4o-mini", messages, self.model_class)
-        return response.choices[0].message.parsed
+        data = _parse_structured("gpt-4o-mini", messages, self.model_class)
+        if data is None:
+            return None
+        parsed = self.model_class.model_validate(data)
+        if vector is not None:
+            self.semantic_cache.set_sync(vector, raw_message, parsed.model_dump_json())
+        return parsed
 
-    def run(self, agent, prompt: str) -> FORMAT_T:
+    def run(self, agent, prompt: str) -> Optional[FORMAT_T]:
         raw_message = agent.chat(prompt)
         return self.format(raw_message)
 
 SJON_T = TypeVar('SJON_T', bound=BaseModel)
+# プロンプトの前に付ける出力形式の指示 ({schema} にスキーマの JSON が入る)
+# 不変のスキーマを先頭に置くことで、プロバイダのプロンプトキャッシュが効く範囲を長くする
+JSON_PROMPT_PREFIX = "Output format is JSON. Schema is:\n{schema}\n\nTask:\n"
+
+
+@functools.lru_cache(maxsize=None)
+def _schema_json(model_class: type[BaseModel]) -> str:
+    """
+    model_class の JSON スキーマの文字列。スキーマはクラスごとに不変なので一度だけ作る。
+    (CodeInterpreterFlow のように毎ターン StructuredJSONFlow を作り直す場合も再計算しない)
+    """
+    return fast_dumps(model_class.model_json_schema())
+
+
 class StructuredJSONFlow(Generic[SJON_T]):
     def __init__(self, model_class: type[SJON_T]):
         self.model_class = model_class
+        self._schema_str = _schema_json(model_class)
+        # プロンプトに付ける指示はモデルごとに不変なので一度だけ組み立てる
+        self._prompt_prefix = JSON_PROMPT_PREFIX.format(schema=self._schema_str)
+        self._retry_prompt = "this output is not valid JSON. Please try again and Must be this output format\n\n" + self._schema_str
     
     def format(self, raw_message: str) -> SJON_T:
-        params = json.loads(raw_message[raw_message.find("{"):raw_message.rfind("}") + 1])
-        return self.model_class(**params)
+        # パースと検証を pydantic-core で1回で行う
+        # (括弧の対応で切り出すので、コードフェンスや前後の文章があってもよい)
+        first_error: Optional[ValueError] = None
+        start = raw_message.find("{")
+        while start >= 0:
+            json_text = extract_json_object(raw_message, start=start)
+            if json_text is None:
+                # 途中で途切れた JSON は括弧を補って試す
+                json_text = extract_json_object(raw_message, repair=True, start=start)
+            try:
+                return self.model_class.model_validate_json(json_text)
+            except ValueError as e:
+                first_error = first_error or e
+            # 説明文やコード例の中の {...} だった場合は、その後ろにある次のオブジェクトを試す
+            start = raw_message.find("{", start + len(json_text))
+        if first_error is not None:
+            raise first_error
+        return self.model_class.model_validate_json(raw_message)
 
     def run(self, agent, prompt: str, max_retry: int=3) -> SJON_T:
-        schema = self.model_class.model_json_schema()
-        JSON_PROMPT_TEMPLATE = "{prompt}\n\nOutput format is JSON.schema is \n\n{schema}"
-        raw_message = agent.chat(JSON_PROMPT_TEMPLATE.format(prompt=prompt, schema=schema))
+        raw_message = agent.chat(self._prompt_prefix + prompt)
         for _ in range(max_retry):
             try:
                 return self.format(raw_message)
             except Exception as e:
+                # ローカルで直せなかった場合だけ LLM に出し直してもらう
                 print("Error:", e)
-                raw_message = agent.chat("this output is not valid JSON. Please try again and Must be this output format\n\n{schema}")
+                raw_message = agent.chat(self._retry_prompt)
@@ -1,5 +1,75 @@
+import copy
+import re
 import json
-from typing import Callable, Optional, List, Dict, Any, Union, get_origin, get_args, get_type_hints
+import types
+import asyncio
+import inspect
+import functools
+import warnings
+from collections.abc import Hashable
+from typing import Callable, Optional, List, Dict, Any, Tuple, Union, get_origin, get_args, get_type_hints
+
+from .utils import fast_loads
+
+try:
+    import fastjsonschema
+except ImportError:  # fastjsonschema が無い環境では引数の検証を行わない
+    fastjsonschema = None
+
+# typing.Union と X | Y 構文 (types.UnionType) のどちらも Union として扱う
+_UNION_TYPES = (Union, types.UnionType)
+
+# 組み込みのプリミティブ型 -> JSON Schema の型
+_PRIMITIVE_JSON_TYPES = {str: "string", int: "integer", bool: "boolean", float: "number"}
+
+# docstring の "param_name (type): 説明" 形式の行にマッチする
+_PARAM_RE = re.compile(r"^[ \t]*(\w+)[ \t]*\([^)\n]*\)[ \t]*:?[ \t]*(.*)$", re.MULTILINE)
+
+
+@functools.lru_cache(maxsize=512)
+def _cached_type_hints(func: Callable) -> Dict[str, Any]:
+    return get_type_hints(func)
+
+
+def _type_hints(func: Callable) -> Dict[str, Any]:
+    """
+    get_type_hints(func) の結果を関数ごとにキャッシュして返す (返り値の辞書は変更しないこと)。
+    アノテーションの評価や ForwardRef の解決を、登録や検証のたびに繰り返さない。
+    """
+    if isinstance(func, Hashable):
+        return _cached_type_hints(func)
+    return get_type_hints(func)
+
+
+@functools.lru_cache(maxsize=256)
+def _extract_non_none(typ: Any) -> Any:
+    """LLMToolParser.extract_non_none_type_if_optional の本体。"""
+    type_origin = get_origin(typ)
+    type_args = get_args(typ)
+
+    # Optional[T] は Union[T, NoneType] なので、Union かつ NoneType を含むかで判定
+    if type_origin in _UNION_TYPES and type(None) in type_args:
+        not_none_args = [arg for arg in type_args if arg is not type(None)]
+        if len(not_none_args) == 1:
+            return not_none_args[0]
+        else:
+            # Union[int, str, NoneType] のように複数が含まれる場合は追加対応が必要
+            raise ValueError(f"サポートされていない複数Union+NoneTypeです: {typ}")
+    return typ
+
+
+@functools.lru_cache(maxsize=512)
+def _doc_arg_index(docstring: str) -> Dict[str, str]:
+    """
+    docstring を1回だけ走査して 引数名 -> 説明行 の辞書にする (同名の行は最初のものを使う)。
+    docstring の文字列をキーにキャッシュするので、__doc__ が書き換えられても古い結果は使わない。
+    返り値の辞書は変更しないこと。
+    """
+    doc_params: Dict[str, str] = {}
+    for m in _PARAM_RE.finditer(docstring):
+        doc_params.setdefault(m.group(1), m.group(0).strip())
+    return doc_params
+
 
 def doc(doc_dict: Dict[str, Any]):
     """
@@ -17,35 +87,39 @@ def doc(doc_dict: Dict[str, Any]):
     """
     def decorator(func: Callable):
         # 型ヒントを取得
-        type_hints = get_type_hints(func)
+        # (クラス定義中などで前方参照がまだ解決できない場合は、評価前のアノテーションを使う)
+        try:
+            type_hints = _type_hints(func)
+        except NameError:
+            type_hints = getattr(func, "__annotations__", {})
+
+        # ドキュメントを構築 (各行をリストに溜めて最後に1回で連結する)
+        parts = [doc_dict.get('description', ''), "\n\n"]
 
-        # ドキュメントを構築
-        docstring = f"{doc_dict.get('description', '')}\n\n"
-        
         # 引数の説明
         if "args" in doc_dict:
-            docstring += "Args:\n"
+            parts.append("Args:\n")
             for arg, desc in doc_dict["args"].items():
                 arg_type = type_hints.get(arg, "Unknown")
                 # arg_type が str などの場合もあるので安全に __name__ を取り出す
-                arg_type_name = arg_type.__name__ if hasattr(arg_type, "__name__") else str(arg_type)
-                docstring += f"    {arg} ({arg_type_name}): {desc}\n"
-        
+                arg_type_name = getattr(arg_type, "__name__", None) or str(arg_type)
+                parts.append(f"    {arg} ({arg_type_name}): {desc}\n")
+
         # 戻り値の説明
         if "returns" in doc_dict:
             return_type = type_hints.get("return", "Unknown")
-            return_type_name = return_type.__name__ if hasattr(return_type, "__name__") else str(return_type)
-            docstring += "\nReturns:\n"
-            docstring += f"    {return_type_name}: {doc_dict['returns']}\n"
-        
+            return_type_name = getattr(return_type, "__name__", None) or str(return_type)
+            parts.append("\nReturns:\n")
+            parts.append(f"    {return_type_name}: {doc_dict['returns']}\n")
+
         # 例外の説明
         if "raises" in doc_dict:
-            docstring += "\nRaises:\n"
+            parts.append("\nRaises:\n")
             for exc, desc in doc_dict["raises"].items():
-                docstring += f"    {exc}: {desc}\n"
-        
+                parts.append(f"    {exc}: {desc}\n")
+
         # 関数の__doc__属性に設定
-        func.__doc__ = docstring
+        func.__doc__ = "".join(parts)
         return func
     return decorator
 
@@ -81,11 +155,26 @@ class LLMToolParser:
             TypeError: 関数がCallableでない場合、または型ヒントがない場合
             ValueError: 無効な型ヒントが指定された場合、またはdocstringがない場合
         """
-        # バリデーションを実行
-        LLMToolParser.validate(func, parameters, required)
+        # 同じ引数での解析結果は関数ごとにキャッシュする (ハッシュできない callable や parameters はキャッシュしない)
+        try:
+            key = (func, name, description, _freeze(required), _FrozenParams(parameters))
+            hash(key)
+        except TypeError:
+            return LLMToolParser._parse_func(func, name, description, required, parameters)
+        # キャッシュしたスキーマを呼び出し側の変更から守るためコピーを返す
+        return copy.deepcopy(_build_schema(*key))
 
-        # 型ヒントの取得
-        type_hints = get_type_hints(func)
+    @staticmethod
+    def _parse_func(
+        func: Callable,
+        name: Optional[str] = None,
+        description: Optional[str] = None,
+        required: Optional[List[str]] = None,
+        parameters: Optional[Dict[str, Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """parse_func の本体 (キャッシュなし)。"""
+        # バリデーションを実行 (検証で取得した型ヒントと引数名を以降でも使う)
+        type_hints, all_params = LLMToolParser.validate(func, parameters, required)
 
         # 名前を設定（省略時は関数の__qualname__を使用）
         if name is None:
@@ -93,14 +182,13 @@ class LLMToolParser:
 
         # 説明を設定（省略時はdocstringを使用）
         if description is None:
-            description = LLMToolParser.get_description(func, name)
+            description = LLMToolParser.get_description(func, name, type_hints)
 
         # 引数の詳細情報を取得
         if parameters is None:
             parameters = LLMToolParser.generate_parameters(func, type_hints)
 
         # 必須引数の設定
-        all_params = [p for p in type_hints.keys() if p != "return"]
         if required is None:
             required = all_params
 
@@ -124,7 +212,7 @@ class LLMToolParser:
         func: Callable,
         parameters: Optional[Dict[str, Dict[str, Any]]] = None,
         required: Optional[List[str]] = None,
-    ) -> None:
+    ) -> Tuple[Dict[str, Any], List[str]]:
         """
         関数とその引数に関するすべてのバリデーションを実行する。
 
@@ -133,6 +221,9 @@ class LLMToolParser:
             parameters (Optional[Dict[str, Dict[str, Any]]]): 引数の詳細情報
             required (Optional[List[str]]): 必須の引数のリスト
 
+        Returns:
+            Tuple[Dict[str, Any], List[str]]: 関数の型ヒントと、戻り値を除いた引数名のリスト
+
         Raises:
             TypeError: 関数がCallableでない場合、または型ヒントがない場合
             ValueError: 無効な型ヒントが指定された場合、またはdocstringがない場合
@@ -142,16 +233,18 @@ class LLMToolParser:
 
         # 型ヒントのバリデーション
         type_hints = LLMToolParser.validate_type_hints(func)
+        all_params = [p for p in type_hints.keys() if p != "return"]
 
         # 引数のバリデーション
         if parameters is not None:
-            LLMToolParser.validate_parameters(parameters, type_hints, func.__qualname__)
+            LLMToolParser.validate_parameters(parameters, all_params, func.__qualname__)
 
         # 必須引数のバリデーション
         if required is not None:
-            all_params = [p for p in type_hints.keys() if p != "return"]
             LLMToolParser.validate_required(required, all_params, func.__qualname__)
 
+        return type_hints, all_params
+
     @staticmethod
     def validate_function(func: Callable) -> None:
         """関数がCallableかどうかを確認する。"""
@@ -161,7 +254,7 @@ class LLMToolParser:
     @staticmethod
     def validate_type_hints(func: Callable) -> Dict[str, Any]:
         """型ヒントが存在するか確認する。"""
-        type_hints = get_type_hints(func)
+        type_hints = _type_hints(func)
         if not type_hints:
             raise TypeError(f"関数に型ヒントがありません: {func.__qualname__}")
         if "return" not in type_hints:
@@ -169,9 +262,8 @@ class LLMToolParser:
         return type_hints
 
     @staticmethod
-    def validate_parameters(parameters: Dict[str, Dict[str, Any]], type_hints: Dict[str, Any], name: str) -> None:
+    def validate_parameters(parameters: Dict[str, Dict[str, Any]], all_params: List[str], name: str) -> None:
         """parametersに指定された引数が関数に存在するか確認する。"""
-        all_params = [p for p in type_hints.keys() if p != "return"]
         for param in parameters.keys():
             if param not in all_params:
                 raise ValueError(f"引数 '{param}' は関数 '{name}' に存在しません。")
@@ -199,7 +291,10 @@ class LLMToolParser:
             Dict[str, Dict[str, Any]]: 引数の詳細情報
         """
         if type_hints is None:
-            type_hints = get_type_hints(func)
+            type_hints = _type_hints(func)
+
+        # docstring の 引数名 -> 説明行 の辞書
+        doc_params = _doc_arg_index(func.__doc__ or "")
 
         parameters = {}
         for param, param_type in type_hints.items():
@@ -212,17 +307,8 @@ class LLMToolParser:
             # JSON Schemaの型に変換
             json_schema_type = LLMToolParser.convert_python_type_to_json_schema_type(param_type)
 
-            # 引数の説明を初期化(型ヒントのみ)
-            param_description = f"{param}: {LLMToolParser.get_type_name(param_type)}"
-
-            # docstring から引数の説明を取得
-            if func.__doc__:
-                doc_lines = func.__doc__.splitlines()
-                for line in doc_lines:
-                    # 例: "param_name (int):" のような記述を探す場合
-                    if f"{param} (" in line:
-                        param_description = line.strip()
-                        break
+            # docstring から引数の説明を取得 (なければ型ヒントのみ)
+            param_description = doc_params.get(param) or f"{param}: {LLMToolParser.get_type_name(param_type)}"
 
             # 文字列の場合は "type": "string" のように入れる
             # 辞書の場合 (例: {"type": "array", "items": ...}) はそれを丸ごと使う
@@ -245,19 +331,13 @@ class LLMToolParser:
         与えられた型が Optional[T] (Union[T, NoneType]) であれば、
         NoneType 以外の型を取り出して返す。
         それ以外の場合はそのまま返す。
+        型ごとの結果はキャッシュする (ハッシュできない型はキャッシュしない)。
         """
-        type_origin = get_origin(typ)
-        type_args = get_args(typ)
-
-        # Optional[T] は Union[T, NoneType] なので、Union かつ NoneType を含むかで判定
-        if type_origin is Union and type(None) in type_args:
-            not_none_args = [arg for arg in type_args if arg is not type(None)]
-            if len(not_none_args) == 1:
-                return not_none_args[0]
-            else:
-                # Union[int, str, NoneType] のように複数が含まれる場合は追加対応が必要
-                raise ValueError(f"サポートされていない複数Union+NoneTypeです: {typ}")
-        return typ
+        try:
+            hash(typ)
+        except TypeError:
+            return _extract_non_none.__wrapped__(typ)
+        return _extract_non_none(typ)
 
     @staticmethod
     def convert_python_type_to_json_schema_type(python_type: Any) -> Any:
@@ -265,19 +345,14 @@ class LLMToolParser:
         Pythonの型をJSON Schemaの型または構造に変換する。
         Returnsには dict もしくは str を返す想定。
         """
+        # 組み込みのプリミティブ型
+        primitive = _PRIMITIVE_JSON_TYPES.get(python_type)
+        if primitive is not None:
+            return primitive
+
         type_origin = get_origin(python_type)
         type_args = get_args(python_type)
 
-        # 組み込みのプリミティブ型
-        if python_type is str:
-            return "string"
-        elif python_type is int:
-            return "integer"
-        elif python_type is bool:
-            return "boolean"
-        elif python_type is float:
-            return "number"
-
         # list, dict のようなコンテナ型
         if type_origin is list:
             # 例: list[int], list[dict[str, Any]] など
@@ -309,16 +384,20 @@ class LLMToolParser:
             if len(type_args) == 2:
                 key_type, value_type = type_args
                 # key を string と断定するなど簡略化
+                value_schema = LLMToolParser.convert_python_type_to_json_schema_type(value_type)
+                if isinstance(value_schema, str):
+                    # プリミティブ型は配列の items と同じく {"type": ...} の形にする
+                    value_schema = {"type": value_schema}
                 return {
                     "type": "object",
-                    "additionalProperties": LLMToolParser.convert_python_type_to_json_schema_type(value_type),
+                    "additionalProperties": value_schema,
                 }
             else:
                 # dict[...] だが型引数が足りないなど
                 return {"type": "object"}
 
         # それ以外の Union 型 (Optional 以外)
-        if type_origin is Union:
+        if type_origin in _UNION_TYPES:
             # Optional[T] 以外の Union はサポート外
             raise ValueError(f"サポートされていない複数Unionです: {python_type}")
 
@@ -326,21 +405,24 @@ class LLMToolParser:
         raise ValueError(f"サポートされていない型です: {python_type}")
 
     @staticmethod
-    def get_description(func: Callable, name: str) -> str:
+    def get_description(func: Callable, name: str, type_hints: Optional[Dict[str, Any]] = None) -> str:
         """
         関数の説明を取得する。
         docstring がなければエラーを発生させ、docstring 追加例を出力する。
+        type_hints を渡すとエラーメッセージの生成で型ヒントを取得し直さない。
         """
         if func.__doc__:
             return func.__doc__.strip()
         else:
             # docstringがない場合、エラーを発生させる
-            type_hints = get_type_hints(func)
-            # 引数の表示用
-            arg_text = ", ".join([
-                f"{p}: {t.__name__}" for p, t in type_hints.items() if p != 'return'
-            ])
-            return_type_name = type_hints['return'].__name__ if 'return' in type_hints else 'None'
+            if type_hints is None:
+                type_hints = _type_hints(func)
+            # 引数の表示用 (型名は1回だけ求める)
+            params = [(p, LLMToolParser.get_type_name(t)) for p, t in type_hints.items() if p != 'return']
+            arg_text = ", ".join(f"{p}: {t}" for p, t in params)
+            return_type_name = LLMToolParser.get_type_name(type_hints['return']) if 'return' in type_hints else 'None'
+            # docstring 例の Args は1行に1つの引数を書く
+            args_text = "\n".join(f"        {p} ({t}): {p}の説明" for p, t in params)
 
             raise ValueError(
                 f"関数 '{name}' にdocstringがありません。以下のようにdocstringを追加してください:\n\n"
@@ -353,7 +435,7 @@ class LLMToolParser:
                 '    """\n'
                 f"    {name} の説明をここに記述します。\n\n"
                 "    Args:\n"
-                f"        {', '.join([f'{p} ({t.__name__}): {p}の説明' for p, t in type_hints.items() if p != 'return'])}\n\n"
+                f"{args_text}\n\n"
                 "    Returns:\n"
                 f"        {return_type_name}: 戻り値の説明\n"
                 '    """\n'
@@ -368,7 +450,7 @@ class LLMToolParser:
         type_origin = get_origin(typ)
         type_args = get_args(typ)
 
-        if type_origin is Union:
+        if type_origin in _UNION_TYPES:
             # 例: Union[int, str] → "int | str"
             return " | ".join(LLMToolParser.get_type_name(arg) for arg in type_args)
         if isinstance(typ, type):
@@ -376,10 +458,114 @@ class LLMToolParser:
         return str(typ)
 
 
+def _freeze(value: Any) -> Any:
+    """dict や list を再帰的にハッシュ可能な tuple に変換する (キャッシュキー用)。"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class _FrozenParams:
+    """
+    parameters をキャッシュキーとして扱うためのラッパー。
+    比較とハッシュは凍結した値で行い、スキーマの生成には元の値を使う。
+    """
+    __slots__ = ("value", "_key")
+
+    def __init__(self, value: Optional[Dict[str, Dict[str, Any]]]):
+        self.value = value
+        self._key = _freeze(value)
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, _FrozenParams) and self._key == other._key
+
+
+@functools.lru_cache(maxsize=256)
+def _build_schema(
+    func: Callable,
+    name: Optional[str],
+    description: Optional[str],
+    required: Optional[Tuple[str, ...]],
+    parameters: _FrozenParams,
+) -> Dict[str, Any]:
+    """
+    関数ごとの JSON Schema を生成してキャッシュする。
+    型ヒントと docstring から決まるスキーマは関数ごとに不変なので、
+    同じ関数を何度登録しても get_type_hints や docstring の解析は1回で済む。
+    """
+    # 呼び出し側の parameters を後から変更されてもキャッシュが変わらないようにコピーして使う
+    return LLMToolParser._parse_func(
+        func,
+        name,
+        description,
+        list(required) if required is not None else None,
+        copy.deepcopy(parameters.value),
+    )
+
+
+def _positional_order(func: Callable) -> Optional[Tuple[str, ...]]:
+    """
+    全ての引数を位置引数としても渡せる関数なら、引数名を定義順に返す。
+    *args, **kwargs, キーワード専用引数, 位置専用引数を持つ場合やシグネチャが取れない場合は None を返す。
+    """
+    try:
+        params = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):
+        return None
+    if any(p.kind is not inspect.Parameter.POSITIONAL_OR_KEYWORD for p in params):
+        return None
+    return tuple(p.name for p in params)
+
+
+_fastjsonschema_warned = False
+
+
+def _warn_no_fastjsonschema() -> None:
+    """validate_arguments が True なのに fastjsonschema が無い場合に、1度だけ警告する。"""
+    global _fastjsonschema_warned
+    if not _fastjsonschema_warned:
+        _fastjsonschema_warned = True
+        warnings.warn(
+            "LLMToolManager.validate_arguments が True ですが fastjsonschema がインストールされていないため、"
+            "引数の検証を行いません (pip install fastjsonschema または .[fast] でインストールしてください)。",
+            RuntimeWarning,
+            stacklevel=3,
+        )
+
+
 class LLMToolManager:
+    # True にすると exec の前に引数を各ツールの parameters スキーマで検証する (fastjsonschema が必要)
+    validate_arguments = False
+
     def __init__(self):
         self.tools = []  # 登録されたツールのJSON Schemaを保持
         self.functions = dict()  # 登録された関数を保持
+        self.concurrent_safe = set()  # 並列実行してよい関数名を保持
+        self._tool_jsons: List[str] = []  # tools の各要素を登録時にシリアライズした文字列 (tools と同じ順序)
+        self._tools_json: Optional[str] = None  # tools をシリアライズした文字列のキャッシュ
+        self._parameters: Dict[str, Dict[str, Any]] = {}  # 関数名 -> parameters スキーマ
+        self._validators: Dict[str, Callable[[Any], Any]] = {}  # コンパイル済みの引数バリデーター
+        self._param_order: Dict[str, Tuple[str, ...]] = {}  # 位置引数で呼び出せる関数の引数名の順序
+
+    @property
+    def tools_json(self) -> str:
+        """
+        登録されたツールのJSON Schemaを整形済みのJSON文字列で返す。
+        ツールが追加されるまではシリアライズ結果を使い回す。
+        各ツールは登録時にシリアライズ済みなので、ここでは連結するだけで済む。
+        (json.dumps(self.tools, indent=2, ensure_ascii=False) と同じ文字列になる)
+        """
+        if self._tools_json is None:
+            if self._tool_jsons:
+                self._tools_json = "[\n  " + ",\n  ".join(self._tool_jsons) + "\n]"
+            else:
+                self._tools_json = "[]"
+        return self._tools_json
 
     def register(
         self,
@@ -388,6 +574,7 @@ class LLMToolManager:
         description: Optional[str] = None,
         required: Optional[List[str]] = None,
         parameters: Optional[Dict[str, Dict[str, Any]]] = None,
+        concurrent_safe: bool = False,
     ) -> Dict[str, Any]:
         """
         関数を登録し、JSON Schemaを生成する。
@@ -398,19 +585,32 @@ class LLMToolManager:
             description (Optional[str]): 関数の説明（省略時はdocstringを使用）
             required (Optional[List[str]]): 必須の引数のリスト（省略時は全ての引数を必須とする）
             parameters (Optional[Dict[str, Dict[str, Any]]]): 引数の詳細情報（省略時は型ヒントとdocstringから生成）
+            concurrent_safe (bool): 副作用がなく他のツールと並列に実行してよい場合は True
 
         Returns:
             Dict[str, Any]: 生成されたJSON Schema
         """
-        # JSON Schemaを生成
+        # JSON Schemaを生成 (同じ関数の解析結果はキャッシュされる)
         schema = LLMToolParser.parse_func(func, name, description, required, parameters)
 
         # 関数を登録
         func_name = name if name is not None else func.__qualname__
         self.functions[func_name] = func
+        self._parameters[func_name] = schema["function"]["parameters"]
+        self._validators.pop(func_name, None)
+        order = _positional_order(func)
+        if order is not None:
+            self._param_order[func_name] = order
+        else:
+            self._param_order.pop(func_name, None)
+        if concurrent_safe:
+            self.concurrent_safe.add(func_name)
 
         # JSON Schemaをツールリストに追加
         self.tools.append(schema)
+        # リストの要素として埋め込むので、2段目のインデントを付けておく
+        self._tool_jsons.append(json.dumps(schema, indent=2, ensure_ascii=False).replace("\n", "\n  "))
+        self._tools_json = None
 
         return schema
 
@@ -430,7 +630,8 @@ class LLMToolManager:
         """
         # 関数名と引数を取得
         func_name = res.name
-        arguments = json.loads(res.arguments)
+        # OpenAI 互換の tool_calls は JSON 文字列、GeminiToolUse は dict で引数を持つ
+        arguments = res.arguments if isinstance(res.arguments, dict) else fast_loads(res.arguments)
 
         # 関数が登録されているか確認
         if func_name not in self.functions:
@@ -439,5 +640,61 @@ class LLMToolManager:
         # 関数を取得
         func = self.functions[func_name]
 
+        # 引数を検証
+        if self.validate_arguments and fastjsonschema is None:
+            _warn_no_fastjsonschema()
+        elif self.validate_arguments:
+            try:
+                self._validator(func_name)(arguments)
+            except fastjsonschema.JsonSchemaException as e:
+                raise ValueError(f"関数 '{func_name}' の引数が不正です: {e.message}") from e
+
         # 引数を関数に渡して実行
+        # 全ての引数が揃っている場合は、キーワード引数の照合を省いて位置引数で渡す
+        order = self._param_order.get(func_name)
+        if order is not None and len(order) == len(arguments) and all(p in arguments for p in order):
+            return func(*[arguments[p] for p in order])
         return func(**arguments)
+
+    def _validator(self, func_name: str) -> Callable[[Any], Any]:
+        """
+        関数の parameters スキーマをコンパイルした検証関数を返す。コンパイルは関数ごとに1回だけ行う。
+        """
+        validator = self._validators.get(func_name)
+        if validator is None:
+            validator = self._validators[func_name] = fastjsonschema.compile(self._parameters[func_name])
+        return validator
+
+    async def exec_many(self, calls: List[Any]) -> List[Any]:
+        """
+        複数のツール呼び出しを実行する。
+        concurrent_safe な関数が連続する区間はスレッドで並列に実行し、
+        それ以外の関数は前後の呼び出しとの順序を保って1つずつ実行する。
+
+        Args:
+            calls (List[Any]): LLMの戻り値(res.choices[0].message.tool_calls[i].function)のリスト
+
+        Returns:
+            List[Any]: 呼び出しと同じ順序の実行結果。失敗した呼び出しは例外オブジェクトを返す。
+        """
+        results: List[Any] = []
+        batch: List[Any] = []
+
+        async def flush() -> None:
+            results.extend(await asyncio.gather(
+                *[asyncio.to_thread(self.exec, res) for res in batch],
+                return_exceptions=True,
+            ))
+            batch.clear()
+
+        for res in calls:
+            if res.name in self.concurrent_safe:
+                batch.append(res)
+                continue
+            await flush()
+            try:
+                results.append(await asyncio.to_thread(self.exec, res))
+            except Exception as e:
+                results.append(e)
+        await flush()
+        return results
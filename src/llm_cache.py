@@ -0,0 +1,204 @@
+import os
+import time
+import sqlite3
+import math
+import hashlib
+import functools
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence, TypeVar
+
+from .utils import fast_dumps, fast_loads
+
+# LLM_CACHE=1 のときだけレスポンスキャッシュを有効にする
+LLM_CACHE_ENABLED = os.environ.get("LLM_CACHE") == "1"
+# LLM_CACHE_PATH を指定するとキャッシュを SQLite ファイルに保存し、再起動後も再利用する
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH")
+# LLM_CACHE_TTL (秒) を指定するとそれより古いエントリは使わない
+LLM_CACHE_TTL = float(os.environ["LLM_CACHE_TTL"]) if os.environ.get("LLM_CACHE_TTL") else None
+
+
+def make_cache_key(
+    model: str,
+    messages: List[Dict[str, Any]],
+    tools: Optional[List[Dict[str, Any]]] = None,
+    response_format: Optional[str] = None,
+) -> str:
+    """
+    (model, messages, tools, response_format) から決定的なキャッシュキーを生成する。
+    """
+    key = {"model": model, "messages": messages, "tools": tools}
+    if response_format is not None:
+        key["response_format"] = response_format
+    payload = fast_dumps(key, sort_keys=True)
+    return hashlib.blake2b(payload.encode()).hexdigest()
+
+
+class LLMCache:
+    """
+    LLM のレスポンスをメモリ上に保持する非同期キャッシュ。
+    同じ入力に対する API 呼び出しを省略するために使う。
+    """
+    def __init__(self, ttl: Optional[float] = None):
+        self.ttl = ttl
+        self._store: Dict[str, Any] = {}
+
+    def get_sync(self, key: str) -> Optional[Any]:
+        entry = self._store.get(key)
+        if entry is None:
+            return None
+        value, created = entry
+        if self.ttl is not None and time.time() - created > self.ttl:
+            return None
+        return value
+
+    def set_sync(self, key: str, value: Any) -> None:
+        self._store[key] = (value, time.time())
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self.get_sync(key)
+
+    async def set(self, key: str, value: Any) -> None:
+        self.set_sync(key, value)
+
+    async def clear(self) -> None:
+        self._store.clear()
+
+
+class SQLiteLLMCache:
+    """
+    LLM のレスポンスを SQLite に保存する非同期キャッシュ。
+    LLMCache と同じインターフェースで、プロセスを再起動してもキャッシュが残る。
+    接続はインスタンスごとに1つだけ開き、スレッド間ではロックで直列化する。
+    """
+    def __init__(self, path: str, ttl: Optional[float] = None):
+        self.ttl = ttl
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, resp TEXT, created REAL)"
+            )
+            self._conn.commit()
+
+    def get_sync(self, key: str) -> Optional[Any]:
+        oldest = time.time() - self.ttl if self.ttl is not None else 0.0
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT resp FROM llm_cache WHERE key = ? AND created >= ?", (key, oldest)
+            ).fetchone()
+        return fast_loads(row[0]) if row else None
+
+    def set_sync(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, resp, created) VALUES (?, ?, ?)",
+                (key, fast_dumps(value), time.time()),
+            )
+            self._conn.commit()
+
+    async def get(self, key: str) -> Optional[Any]:
+        return self.get_sync(key)
+
+    async def set(self, key: str, value: Any) -> None:
+        self.set_sync(key, value)
+
+    async def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+
+
+class SemanticCache:
+    """
+    プロンプトの埋め込みベクトルのコサイン類似度でレスポンスを引く非同期キャッシュ。
+    言い回しが違うだけの同じ質問にも保存済みのレスポンスを返す。
+    ベクトルは正規化して保持し、内積 (= コサイン類似度) で全件を線形探索する。
+    path を指定すると JSONL に追記し、次回起動時に読み込む。
+    """
+    def __init__(self, threshold: float = 0.92, ttl: Optional[float] = None, path: Optional[str] = None):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.path = path
+        self._vectors: List[List[float]] = []
+        self._entries: List[Dict[str, Any]] = []
+        if path is not None and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = fast_loads(line)
+                        self._vectors.append(entry.pop("vector"))
+                        self._entries.append(entry)
+
+    @staticmethod
+    def _normalize(vector: Sequence[float]) -> List[float]:
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def get_sync(self, vector: Sequence[float]) -> Optional[str]:
+        """
+        類似度が threshold 以上で最も近いエントリのレスポンスを返す。期限切れのエントリは無視する。
+        """
+        query = self._normalize(vector)
+        now = time.time()
+        best_score, best = self.threshold, None
+        for stored, entry in zip(self._vectors, self._entries):
+            if self.ttl is not None and now - entry["created"] > self.ttl:
+                continue
+            score = sum(a * b for a, b in zip(query, stored))
+            if score >= best_score:
+                best_score, best = score, entry
+        return best["response"] if best is not None else None
+
+    def set_sync(self, vector: Sequence[float], prompt: str, response: str) -> None:
+        normalized = self._normalize(vector)
+        entry = {"prompt": prompt, "response": response, "created": time.time()}
+        self._vectors.append(normalized)
+        self._entries.append(entry)
+        if self.path is not None:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(fast_dumps({**entry, "vector": normalized}) + "\n")
+
+    async def get(self, vector: Sequence[float]) -> Optional[str]:
+        return self.get_sync(vector)
+
+    async def set(self, vector: Sequence[float], prompt: str, response: str) -> None:
+        self.set_sync(vector, prompt, response)
+
+    async def clear(self) -> None:
+        self._vectors.clear()
+        self._entries.clear()
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# プロセス内で共有するキャッシュ
+default_cache = SQLiteLLMCache(LLM_CACHE_PATH, LLM_CACHE_TTL) if LLM_CACHE_PATH else LLMCache(LLM_CACHE_TTL)
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def cached_llm_call(func: F) -> F:
+    """
+    同期の LLM 呼び出し func(model, messages, response_format) の戻り値を default_cache に保存するデコレーター。
+    キーは (model, messages, response_format のクラス名) で、LLM_CACHE=1 のときだけ有効になる。
+    戻り値は JSON に変換できる値にすること (SQLite に保存するため)。None は保存しない。
+    """
+    @functools.wraps(func)
+    def wrapper(model: str, messages: List[Dict[str, Any]], response_format: type) -> Any:
+        if not LLM_CACHE_ENABLED:
+            return func(model, messages, response_format)
+        key = make_cache_key(
+            model, messages, response_format=f"{response_format.__module__}.{response_format.__qualname__}"
+        )
+        cached = default_cache.get_sync(key)
+        if cached is not None:
+            return cached
+        result = func(model, messages, response_format)
+        # None (応答の拒否など) は保存せず、次回は呼び直す
+        if result is not None:
+            default_cache.set_sync(key, result)
+        return result
+    return wrapper  # type: ignore[return-value]
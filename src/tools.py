@@ -1,9 +1,24 @@
+import io
 import os
+import re
+import mmap
+import bisect
 import fnmatch
-from typing import List, Dict, Any
+import functools
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Callable, Iterator, Optional, Tuple
 
 from .type import Agent
 from .function_call import doc
+from .llm_cache import LLM_CACHE_ENABLED, default_cache, make_cache_key
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick が無い環境では検索語ごとに部分文字列を探す
+    ahocorasick = None
 
 
 @doc({
@@ -64,6 +79,37 @@ def make_dirs(path: str) -> None:
         raise OSError(f"ディレクトリ '{path}' の作成に失敗しました: {e}")
 
 
+def _walk_entries(
+    directory_path: str,
+    depth: int,
+    skip: Optional[Callable[[os.DirEntry, str], bool]] = None,
+) -> Iterator[os.DirEntry]:
+    """
+    directory_path 以下のエントリを depth の深さまで、再帰呼び出しと同じ深さ優先の順に返す。
+    再帰の代わりに scandir のイテレータを deque に積んで辿る。
+    skip(entry, 起点からの相対パス) が True を返したエントリは返さず、ディレクトリならその中にも入らない。
+    """
+    if depth < 1:
+        return
+    stack = deque([(os.scandir(directory_path), 1, "")])
+    try:
+        while stack:
+            entries, current_depth, relative_dir = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                entries.close()
+                stack.pop()
+                continue
+            if skip is not None and skip(entry, relative_dir + entry.name):
+                continue
+            yield entry
+            if current_depth < depth and entry.is_dir():
+                stack.append((os.scandir(entry.path), current_depth + 1, relative_dir + entry.name + os.sep))
+    finally:
+        for entries, _, _ in stack:
+            entries.close()
+
+
 @doc({
     "description": "指定されたディレクトリ内のファイルを検索します。",
     "args": {
@@ -75,19 +121,11 @@ def make_dirs(path: str) -> None:
     "raises": {},
 })
 def search_filename(directory_path: str, search_string: str, depth: int = 1) -> List[str]:
-    results = []
-
-    def _search(current_path: str, current_depth: int) -> None:
-        if current_depth > depth:
-            return
-        for entry in os.scandir(current_path):
-            if entry.is_file() and search_string in entry.name:
-                results.append(entry.path)
-            elif entry.is_dir():
-                _search(entry.path, current_depth + 1)
-
-    _search(directory_path, 1)
-    return results
+    return [
+        entry.path
+        for entry in _walk_entries(directory_path, depth)
+        if entry.is_file() and search_string in entry.name
+    ]
 
 @doc({
     "description": "指定されたディレクトリ内のファイルとサブディレクトリを探索します。",
@@ -110,26 +148,68 @@ def explore_directory(
     include_directories: bool = False,
 ) -> List[Dict[str, Any]]:
     results = []
-
-    def _explore(current_path: str, current_depth: int) -> None:
-        if current_depth > depth:
-            return
-        for entry in os.scandir(current_path):
-            entry_info = {
-                "name": entry.name,
-                "path": entry.path,
-            }
-            if entry.is_file() and include_files:
-                entry_info["type"] = "file"
-                results.append(entry_info)
-            elif entry.is_dir():
-                if include_directories:
-                    entry_info["type"] = "directory"
-                    results.append(entry_info)
-                _explore(entry.path, current_depth + 1)
-
-    _explore(directory_path, 1)
+    for entry in _walk_entries(directory_path, depth):
+        if entry.is_file():
+            if include_files:
+                results.append({"name": entry.name, "path": entry.path, "type": "file"})
+        elif entry.is_dir() and include_directories:
+            results.append({"name": entry.name, "path": entry.path, "type": "directory"})
     return results
+
+
+# search_in_files でファイルを並列に検索するスレッド数と、1度にまとめて検索するファイル数
+SEARCH_WORKERS = min(32, (os.cpu_count() or 1) * 2)
+SEARCH_BATCH_SIZE = SEARCH_WORKERS * 2
+# search_in_files でファイルを読み込むときのバッファサイズ
+READ_BUFFER_SIZE = 1 << 20
+# search_in_files でバイナリファイルかどうかを判定するために調べる先頭のバイト数
+BINARY_SNIFF_SIZE = 8192
+
+
+@functools.lru_cache(maxsize=4096)
+def _translate_glob(pattern: str) -> str:
+    """glob パターンを正規表現の文字列に変換する。パターンごとに結果をキャッシュする。"""
+    return fnmatch.translate(pattern)
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_patterns(patterns: Tuple[str, ...]) -> Optional[re.Pattern]:
+    """
+    glob パターンを1つの正規表現にまとめてコンパイルする。パターンの組ごとに結果をキャッシュする。
+    パターンの組が変わっても、個々のパターンの変換結果は _translate_glob のキャッシュを使い回す。
+    パターンがなければ None を返す。
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{_translate_glob(p)})" for p in patterns))
+
+
+_EXTENSION_PATTERN = re.compile(r"\*\.\w+")
+_DIRECTORY_PATTERN = re.compile(r"[^/*?\[]+/")
+
+# .gitignore のパターンを分類したもの: (拡張子の集合, ディレクトリ名の集合, 残りのパターンの正規表現)
+IgnoreRules = Tuple[frozenset, frozenset, Optional[re.Pattern]]
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_ignore_patterns(patterns: Tuple[str, ...]) -> IgnoreRules:
+    """
+    .gitignore のパターンを、拡張子だけのもの ("*.pyc")、ディレクトリ名だけのもの ("node_modules/")、それ以外に分ける。
+    前の2つは集合の参照で判定でき、正規表現を使うのは残りのパターンだけになる。
+    """
+    extensions = set()
+    directories = set()
+    others = []
+    for pattern in patterns:
+        if _EXTENSION_PATTERN.fullmatch(pattern):
+            extensions.add(pattern[1:])
+        elif _DIRECTORY_PATTERN.fullmatch(pattern):
+            directories.add(pattern[:-1])
+        else:
+            others.append(pattern)
+    return frozenset(extensions), frozenset(directories), _compile_patterns(tuple(others))
+
+
 @doc({
     "description": "指定されたディレクトリ内のファイルを再帰的に検索し、指定された文字列を含む行を返します。.gitignore を参照して無視するファイルやディレクトリをスキップできます。",
     "args": {
@@ -156,82 +236,185 @@ def search_in_files(
     max_result_count: int = 5,
     chunk_size: int = 10,
 ) -> List[Dict[str, Any]]:
-    def _parse_gitignore(directory_path: str) -> List[str]:
+    def _parse_gitignore(directory_path: str) -> Optional[IgnoreRules]:
         """
-        .gitignore ファイルをパースし、無視するパターンのリストを返す。
+        .gitignore ファイルをパースし、無視するパターンを分類して返す。
 
         Args:
             directory_path (str): .gitignore ファイルがあるディレクトリのパス
 
         Returns:
-            List[str]: 無視するパターンのリスト
+            Optional[IgnoreRules]: 分類した無視パターン（.gitignore がなければ None）
         """
         gitignore_path = os.path.join(directory_path, ".gitignore")
-        if not os.path.exists(gitignore_path):
-            return []
-
-        with open(gitignore_path, "r", encoding="utf-8") as file:
-            patterns = [line.strip() for line in file if line.strip() and not line.startswith("#")]
-        return patterns
+        try:
+            with open(gitignore_path, "r", encoding="utf-8") as file:
+                patterns = [line.strip() for line in file if line.strip() and not line.startswith("#")]
+        except FileNotFoundError:
+            return None
+        return _compile_ignore_patterns(tuple(patterns))
 
-    def _is_ignored(path: str, patterns: List[str]) -> bool:
+    def _is_ignored(relative_path: str, name: str, is_dir: bool, ignore_rules: Optional[IgnoreRules]) -> bool:
         """
         指定されたパスが .gitignore のパターンにマッチするか確認する。
 
         Args:
-            path (str): 確認するパス
-            patterns (List[str]): .gitignore のパターンリスト
+            relative_path (str): 検索の起点からの相対パス
+            name (str): ファイルまたはディレクトリの名前
+            is_dir (bool): ディレクトリかどうか
+            ignore_rules (Optional[IgnoreRules]): 分類した .gitignore のパターン
 
         Returns:
             bool: 無視する場合は True、そうでない場合は False
         """
-        relative_path = os.path.relpath(path, start=os.path.dirname(path))
-        for pattern in patterns:
-            if fnmatch.fnmatch(relative_path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern):
-                return True
-        return False
+        if ignore_rules is None:
+            return False
+        extensions, directories, ignore_regex = ignore_rules
+        # 拡張子とディレクトリ名は集合で判定し、残りのパターンだけ正規表現で調べる
+        dot = name.rfind(".")
+        if dot >= 0 and name[dot:] in extensions:
+            return True
+        if is_dir and name in directories:
+            return True
+        if ignore_regex is None:
+            return False
+        # 検索の起点からの相対パスと、ファイル名のどちらかがマッチすれば無視する
+        return bool(ignore_regex.match(relative_path) or ignore_regex.match(name))
 
     results = []
-    ignore_patterns = _parse_gitignore(directory_path) if use_gitignore else []
+    ignore_patterns = _parse_gitignore(directory_path) if use_gitignore else None
     search_terms = search_string.split()
+    # 照合の前に検索語とテキストに適用する変換。大文字小文字を区別しない場合だけ小文字にそろえる。
+    # ここで1度だけ選んでおき、ファイルやチャンクごとに case_sensitive で分岐しない
+    fold_case: Callable[[str], str] = str if case_sensitive else str.lower
+    match_terms = list(dict.fromkeys(map(fold_case, search_terms)))
+
+    # ファイル全体に検索語が含まれるかをバイト列のまま調べる正規表現 (デコード前の絞り込み用)。
+    # 大文字小文字を区別しない場合、bytes の IGNORECASE は ASCII しか扱えないので、ASCII 以外を含む語は絞り込みに使わない
+    if case_sensitive:
+        term_patterns = [re.compile(re.escape(term.encode())) for term in match_terms]
+    else:
+        term_patterns = [re.compile(re.escape(term.encode()), re.IGNORECASE) for term in match_terms if term.isascii()]
+
+    # 検索語が複数ある場合、pyahocorasick があればチャンクを1回走査するだけで全ての語の有無を調べる
+    automaton = None
+    if ahocorasick is not None and len(match_terms) > 1:
+        automaton = ahocorasick.Automaton()
+        for index, term in enumerate(match_terms):
+            automaton.add_word(term, index)
+        automaton.make_automaton()
+        all_found = (1 << len(match_terms)) - 1
+
+    def _contains_all_terms(text: str) -> bool:
+        """text に全ての検索語が含まれるかを調べる。"""
+        if automaton is None:
+            return all(term in text for term in match_terms)
+        found = 0
+        for _, index in automaton.iter(text):
+            found |= 1 << index
+            if found == all_found:
+                return True
+        return False
 
-    def _search_in_file(file_path: str) -> None:
-        if use_gitignore and _is_ignored(file_path, ignore_patterns):
+    def _may_contain_terms(file_path: str) -> bool:
+        """
+        ファイルを mmap して、全ての検索語が含まれる可能性があるかを調べる。
+        grep と同じく、先頭 BINARY_SNIFF_SIZE バイトに NUL を含むファイルはバイナリとみなして False を返す。
+        """
+        with open(file_path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm.find(b"\x00", 0, BINARY_SNIFF_SIZE) >= 0:
+                    return False
+                return all(pattern.search(mm) for pattern in term_patterns)
+
+    def _matching_chunks(lines: List[str]) -> Iterator[int]:
+        """
+        chunk_size 行ごとのチャンクのうち、全ての検索語を含むものの先頭の行番号 (0 始まり) を順に返す。
+        ファイル全体を1度だけ連結・小文字化し、最初の検索語が現れる位置から行の開始位置を二分探索して
+        候補のチャンクだけを調べる。
+        """
+        text = ''.join(lines)
+        haystack = fold_case(text)
+        if not match_terms or len(haystack) != len(text):
+            # 検索語がない場合と、小文字化で文字数が変わり位置がずれる場合はチャンクごとに調べる
+            for start_line in range(0, len(lines), chunk_size):
+                chunk_text = ''.join(lines[start_line:start_line + chunk_size])
+                if _contains_all_terms(fold_case(chunk_text)):
+                    yield start_line
             return
+        line_offsets = [0, *itertools.accumulate(map(len, lines))]
+        first_term = match_terms[0]
+        position = haystack.find(first_term)
+        while position >= 0:
+            start_line = bisect.bisect_right(line_offsets, position) - 1
+            start_line -= start_line % chunk_size
+            end_offset = line_offsets[min(start_line + chunk_size, len(lines))]
+            if _contains_all_terms(haystack[line_offsets[start_line]:end_offset]):
+                yield start_line
+            # 同じチャンクは1度だけ調べる
+            position = haystack.find(first_term, end_offset)
+
+    def _search_in_file(file_path: str) -> List[Dict[str, Any]]:
+        # .gitignore の判定は _walk_entries で済んでいる
+        matches = []
         try:
-            with open(file_path, "r", encoding="utf-8") as file:
-                lines = file.readlines()
-                for start_line in range(0, len(lines), chunk_size):
-                    chunk = lines[start_line:start_line + chunk_size]
-                    chunk_text = ''.join(chunk).lower() if not case_sensitive else ''.join(chunk)
-                    if all(term.lower() in chunk_text for term in search_terms):
-                        results.append({
-                            "file_path": file_path,
-                            "line_number": start_line + 1,
-                            "line_content": ''.join(chunk).strip(),
-                            "context": [line.strip() for line in chunk],
-                        })
-                    if len(results) >= max_result_count:
-                        return
+            # バイナリファイルと検索語を含まないファイルはテキストとして読み込まずに飛ばす
+            if not _may_contain_terms(file_path):
+                return matches
+            # 1 MiB のバッファでバイト列として一度に読み込み、まとめてデコードしてから行に分ける。
+            # StringIO(newline=None) はテキストモードの readlines と同じく改行コードを "\n" にそろえる
+            with open(file_path, "rb", buffering=READ_BUFFER_SIZE) as file:
+                data = file.read()
+            lines = io.StringIO(data.decode("utf-8"), newline=None).readlines()
+            for start_line in _matching_chunks(lines):
+                chunk = lines[start_line:start_line + chunk_size]
+                matches.append({
+                    "file_path": file_path,
+                    "line_number": start_line + 1,
+                    "line_content": ''.join(chunk).strip(),
+                    "context": [line.strip() for line in chunk],
+                })
+                if len(matches) >= max_result_count:
+                    break
         except Exception as e:
             print(f"ファイル '{file_path}' の読み取り中にエラーが発生しました: {e}")
-            return
+        return matches
+
+    def _skip_ignored(entry: os.DirEntry, relative_path: str) -> bool:
+        """.gitignore で無視するエントリか。無視するディレクトリの中は探索しない。"""
+        return _is_ignored(relative_path, entry.name, entry.is_dir(), ignore_patterns)
+
+    # ファイルの読み取りは I/O 待ちなので、SEARCH_BATCH_SIZE 件ずつスレッドで並列に検索する。
+    # 結果は探索順に並べ、max_result_count 件に達したら残りのファイルは読まない。
+    files = (
+        entry.path
+        for entry in _walk_entries(directory_path, depth, _skip_ignored if use_gitignore else None)
+        if entry.is_file()
+    )
+    executor: Optional[ThreadPoolExecutor] = None
+    try:
+        while len(results) < max_result_count:
+            batch = list(itertools.islice(files, SEARCH_BATCH_SIZE))
+            if not batch:
+                break
+            if len(batch) <= 4:
+                # ファイルが少ないときはスレッドを使わない
+                found = map(_search_in_file, batch)
+            else:
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+                found = executor.map(_search_in_file, batch)
+            for matches in found:
+                results.extend(matches)
+                if len(results) >= max_result_count:
+                    break
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+    return results[:max_result_count]
 
-    def _explore(current_path: str, current_depth: int) -> None:
-        if current_depth > depth:
-            return
-        for entry in os.scandir(current_path):
-            if use_gitignore and _is_ignored(entry.path, ignore_patterns):
-                continue
-            if entry.is_file():
-                _search_in_file(entry.path)
-            elif entry.is_dir():
-                _explore(entry.path, current_depth + 1)
-            if len(results) >= max_result_count:
-                return
-
-    _explore(directory_path, 1)
-    return results
 
 @doc({
     "description": "作業が完了したら呼んでください。",
@@ -257,9 +440,15 @@ def user_input(
     return input(message)
 
 
+CODE_MARKDOWN_TEMPLATE = "{filepath}\n```python\n{code}\n```"
+
 class CodeReviewer:
   def __init__(self, llm: Agent):
     self.llm = llm
+    # 並列にツール実行されても同じ llm の履歴が混ざらないようにする
+    self._lock = threading.Lock()
+    # LLM_CACHE=1 のときは、ファイルの中身と追加情報が同じレビューの結果を再利用する
+    self.cache = default_cache if LLM_CACHE_ENABLED else None
 
   @doc({
       "description": "コードレビューをAIエージェントに依頼します。",
@@ -271,17 +460,43 @@ class CodeReviewer:
       "raises": {},
   }) 
   def review_code(self, files: List[str], additional_info: str) -> str:
-    code = ""
-    code_markdown_template = "{filepath}\n```python\n{code}\n```"
-    for filepath in files:
-      with open(filepath, "r") as f:
-        code += code_markdown_template.format(filepath=filepath, code=f.read())
-    res = self.llm.chat(f"Please find this code bug. \n code: ```\n{code}\n``` \n additional info: {additional_info}")
+    # ファイルの読み込みはスレッドで並列に行い、最後に1度だけ連結する
+    if len(files) > 1:
+      with ThreadPoolExecutor(max_workers=min(len(files), SEARCH_WORKERS)) as executor:
+        code = "".join(executor.map(self._read_code, files))
+    else:
+      code = "".join(map(self._read_code, files))
+    prompt = f"Please find this code bug. \n code: ```\n{code}\n``` \n additional info: {additional_info}"
+    with self._lock:
+      key = None
+      if self.cache is not None:
+        # プロンプトにはファイルの中身が全て入っている。それまでの会話が違えば結果も変わるので履歴もキーに含める。
+        # キャッシュにヒットした場合、このやり取りは llm の履歴に追加されない
+        history = [{"role": m.role, "content": m.content} for m in self.llm.messages]
+        key = make_cache_key(self._model_name(), history + [{"role": "user", "content": prompt}])
+        cached = self.cache.get_sync(key)
+        if cached is not None:
+          return cached
+      res = self.llm.chat(prompt)
+    if key is not None:
+      self.cache.set_sync(key, res)
     return res
 
+  def _model_name(self) -> str:
+    # Gemini の model は GenerativeModel なので、文字列のモデル名を優先する
+    name = getattr(self.llm, "model_name", None) or getattr(self.llm, "model", None)
+    return name if isinstance(name, str) else type(self.llm).__name__
+
+  @staticmethod
+  def _read_code(filepath: str) -> str:
+    with open(filepath, "r", buffering=READ_BUFFER_SIZE) as f:
+      return CODE_MARKDOWN_TEMPLATE.format(filepath=filepath, code=f.read())
+
 class TaskReviewer:
   def __init__(self, llm: Agent):
     self.llm = llm
+    # 並列にツール実行されても同じ llm の履歴が混ざらないようにする
+    self._lock = threading.Lock()
 
   @doc({
       "description": "タスクを終了しても良いかどうかを確認します。また残タスクがある場合は次のタスクを指示します。",
@@ -293,7 +508,8 @@ class TaskReviewer:
       "raises": {},
   }) 
   def review_task(self, goal:str, history: List[str], additional_info: str) -> str:
-    res = self.llm.chat(f"Please check task is complete. \n ゴール: \n{goal}\n\n やったこと: \n {history} \n\n additional info: {additional_info}")
+    with self._lock:
+      res = self.llm.chat(f"Please check task is complete. \n ゴール: \n{goal}\n\n やったこと: \n {history} \n\n additional info: {additional_info}")
     return res
 
 class Planner:
@@ -41,10 +41,17 @@ class Agent(ABC):
         """
         pass
 
+    # messages プロパティの変換結果のキャッシュ。履歴を変更したら _dirty を True にする。
+    # _cached_messages はクラスで共有しないよう既定値を持たせず、最初に messages を読んだときにインスタンスごとに作る
+    _dirty = True
+    _cached_messages: List[Message]
+
     def append_message(self, message: Dict):
         self._messages.append(message)
+        self._dirty = True
     def pop_message(self):
         self._messages.pop()
+        self._dirty = True
 
 class CodeGenerator(Agent):
     @abstractmethod
@@ -0,0 +1,230 @@
+import json
+import asyncio
+import itertools
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+try:
+    import orjson
+except ImportError:  # orjson が無い環境では標準の json にフォールバックする
+    orjson = None
+
+try:
+    import h2  # noqa: F401  httpx の HTTP/2 サポートに必要
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def fast_dumps(obj: Any, indent: bool = False, sort_keys: bool = False) -> str:
+    """
+    obj を JSON 文字列に変換する。
+    orjson があればそれを使い、なければ標準の json を使う。
+    どちらの場合も非 ASCII 文字はエスケープしない。
+
+    Args:
+        obj (Any): 変換するオブジェクト
+        indent (bool): True の場合は 2 スペースでインデントする
+        sort_keys (bool): True の場合は辞書のキーをソートする (キャッシュキーの生成用)
+
+    Returns:
+        str: JSON 文字列
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, option=option).decode()
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False, sort_keys=sort_keys)
+
+
+def fast_loads(s: Union[str, bytes]) -> Any:
+    """
+    JSON 文字列をパースする。orjson があればそれを使う。
+
+    Raises:
+        json.JSONDecodeError: JSON として不正な場合 (orjson.JSONDecodeError もこのサブクラス)
+    """
+    if orjson is not None:
+        return orjson.loads(s)
+    return json.loads(s)
+
+
+def extract_json_object(text: str, repair: bool = False, start: int = 0) -> Optional[str]:
+    """
+    text の start 以降で最初の JSON オブジェクトを、文字列リテラルを考慮して括弧の対応を数えながら1回の走査で取り出す。
+    ネストしたオブジェクトを含んでいても、後ろに余計な "}" や文章があっても正しく切り出せる。
+    repair=True の場合、途中で途切れたオブジェクトは閉じていない文字列と括弧を補って返す。
+    見つからなければ None を返す。
+    """
+    start = text.find("{", start)
+    if start < 0:
+        return None
+    closers: List[str] = []
+    in_str = False
+    escape = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_str:
+            if escape:
+                escape = False
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            in_str = True
+        elif c == "{":
+            closers.append("}")
+        elif c == "[":
+            closers.append("]")
+        elif c in "}]" and closers:
+            closers.pop()
+            if not closers:
+                return text[start:i + 1]
+    if not repair:
+        return None
+    # 末尾で途切れている: 文字列と括弧を閉じる
+    fragment = text[start:]
+    if in_str:
+        if escape:
+            fragment = fragment[:-1]
+        fragment += '"'
+    else:
+        fragment = fragment.rstrip().rstrip(",")
+    return fragment + "".join(reversed(closers))
+
+
+async def ainput(prompt: str = "") -> str:
+    """
+    input() をワーカースレッドで実行する。
+    ユーザーの入力待ちの間もイベントループ上の他のタスクを止めない。
+    """
+    return await asyncio.to_thread(input, prompt)
+
+
+
+def clip_string(string: str, max_length: int) -> str:
+    """
+    string が max_length を超える場合は切り詰める。
+    """
+    if len(string) > max_length:
+        return string[:max_length - 3] + "\n output is too long ..."
+    return string
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    テキストのおおよそのトークン数を返す。
+    トークナイザーは使わず UTF-8 のバイト数から見積もる (英語は約4文字、日本語は約1文字で1トークン)。
+    """
+    if not text:
+        return 0
+    return len(text.encode()) // 4
+
+
+def prune_tool_messages(
+    messages: Sequence[Dict[str, Any]],
+    max_tokens: int = 8000,
+    keep_last: int = 6,
+    clip_length: int = 500,
+) -> bool:
+    """
+    履歴の見積もりトークン数が max_tokens を超えている場合、
+    直近 keep_last 件より古い tool メッセージの内容を clip_length 文字に切り詰める (messages を直接書き換える)。
+    メッセージ自体は削除しないので tool_call_id の対応関係は崩れない。
+    1件でも切り詰めた場合は True を返す (Agent の履歴なら呼び出し側で _dirty を立てる)。
+    """
+    total = sum(estimate_tokens(m.get("content")) for m in messages if isinstance(m.get("content"), str))
+    if total <= max_tokens:
+        return False
+    pruned = False
+    for m in itertools.islice(messages, max(len(messages) - keep_last, 0)):
+        content = m.get("content")
+        if m.get("role") != "tool" or not isinstance(content, str) or len(content) <= clip_length:
+            continue
+        clipped = clip_string(content, clip_length)
+        total -= estimate_tokens(content) - estimate_tokens(clipped)
+        m["content"] = clipped
+        pruned = True
+        if total <= max_tokens:
+            break
+    return pruned
+
+
+class StreamingArrayParser:
+    """
+    ストリーミングで届く JSON テキストから、指定したキーの配列の要素を完成した順に取り出す。
+    レスポンス全体を待たずに最初の要素から処理を始めるために使う。
+
+    例:
+        parser = StreamingArrayParser("code_snippets")
+        for chunk in chunks:
+            for item in parser.feed(chunk):
+                ...
+    """
+    def __init__(self, key: str):
+        self._marker = f'"{key}"'
+        self._buf = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._escape = False
+        self._item_start: Optional[int] = None
+        self.found = False  # 対象の配列の開始を見つけたかどうか
+        self.done = False  # 対象の配列の終わりまで読んだかどうか
+
+    def feed(self, chunk: str) -> List[Any]:
+        """
+        受信したテキストを追加し、新たに完成した配列要素のリストを返す。
+        """
+        self._buf += chunk
+        items: List[Any] = []
+        if not self.found:
+            start = self._buf.find(self._marker)
+            if start < 0:
+                return items
+            bracket = self._buf.find("[", start + len(self._marker))
+            if bracket < 0:
+                return items
+            self.found = True
+            self._pos = bracket + 1
+
+        buf = self._buf
+        while self._pos < len(buf) and not self.done:
+            c = buf[self._pos]
+            if self._in_str:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_str = False
+            elif c == '"':
+                self._in_str = True
+                if self._item_start is None:
+                    self._item_start = self._pos
+            elif c in "[{":
+                if self._item_start is None:
+                    self._item_start = self._pos
+                self._depth += 1
+            elif c in "]}":
+                if self._depth == 0:
+                    # 対象の配列の終わり
+                    self._emit(items)
+                    self.done = True
+                else:
+                    self._depth -= 1
+            elif c == "," and self._depth == 0:
+                self._emit(items)
+            elif not c.isspace() and self._item_start is None:
+                # 数値や true/false/null
+                self._item_start = self._pos
+            self._pos += 1
+        return items
+
+    def _emit(self, items: List[Any]) -> None:
+        if self._item_start is not None:
+            items.append(fast_loads(self._buf[self._item_start:self._pos]))
+            self._item_start = None
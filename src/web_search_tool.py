@@ -11,7 +11,7 @@ class WebSearchTool(BrowserTool):
     def search_duckduckgo(self, query: str) -> str:
         try:
             base_url = 'https://duckduckgo.com/?q='
-            encoded_query = urllib.parse.quote(query)
+            encoded_query = urllib.parse.quote_plus(query)
             full_url = base_url + encoded_query
             return self.fetch_markdown(full_url)
         except Exception as e:
@@ -25,7 +25,7 @@ class WebSearchTool(BrowserTool):
     def search_yahoo(self, query: str) -> str:
         try:
             base_url = 'https://search.yahoo.com/search?p='
-            encoded_query = urllib.parse.quote(query)
+            encoded_query = urllib.parse.quote_plus(query)
             full_url = base_url + encoded_query
             return self.fetch_markdown(full_url)
         except Exception as e: